@@ -0,0 +1,266 @@
+"""
+Banco de pruebas del flujo ``process_*_sentinel`` sin red.
+
+Genera un bucket sintético con el esquema real
+(``zone/year/Month/composites/{indexes,raw}/name.tif``) en un directorio local,
+lo sirve a través de ``LocalObjectStore`` y mide el tiempo de extremo a extremo
+de las funciones de la interfaz.
+
+Uso:
+    python -m app.benchmark --root /tmp/bucket_sintetico --tiles 4 \\
+        --desde 2023-01 --hasta 2023-06 --indice ndvi --entrada geojson
+"""
+import argparse
+import calendar
+import json
+import os
+import shutil
+import string
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from itertools import product
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+
+BUCKET_INDICES = "test-am-products"
+BUCKET_RAW = "sentinel-raw"
+BANDAS_RGB = ["B02_20m", "B03_20m", "B04_20m"]
+CRS_TILES = "EPSG:32630"
+# Las teselas Sentinel-2 miden 109.8 km y se solapan 9.8 km con sus vecinas.
+LADO_TILE = 109800
+PASO_TILE = 100000
+ORIGEN_TILES = (200000, 4500000)
+
+
+def nombres_tiles(n):
+    letras = string.ascii_uppercase
+    return [f"30S{a}{b}" for a, b in product(letras[20:], letras[5:])][:n]
+
+
+def huellas_tiles(n):
+    """
+    Devuelve {zona: (left, bottom, right, top)} en ``CRS_TILES`` para ``n``
+    teselas dispuestas en rejilla, con el solape de las teselas reales.
+    """
+    columnas = max(1, int(np.ceil(np.sqrt(n))))
+    huellas = {}
+    for i, zona in enumerate(nombres_tiles(n)):
+        left = ORIGEN_TILES[0] + (i % columnas) * PASO_TILE
+        top = ORIGEN_TILES[1] - (i // columnas) * PASO_TILE
+        huellas[zona] = (left, top - LADO_TILE, left + LADO_TILE, top)
+    return huellas
+
+
+def meses_entre(desde, hasta):
+    """
+    Lista de (año, mes en inglés) entre dos fechas ``YYYY-MM`` incluidas.
+    """
+    inicio = datetime.strptime(desde, "%Y-%m")
+    fin = datetime.strptime(hasta, "%Y-%m")
+    meses = []
+    year, month = inicio.year, inicio.month
+    while (year, month) <= (fin.year, fin.month):
+        meses.append((year, calendar.month_name[month]))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return meses
+
+
+def _escribir_tif(ruta, datos, left, top, resolucion, nodata):
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with rasterio.open(
+        ruta,
+        "w",
+        driver="GTiff",
+        width=datos.shape[1],
+        height=datos.shape[0],
+        count=1,
+        dtype=datos.dtype,
+        crs=CRS_TILES,
+        transform=from_origin(left, top, resolucion, resolucion),
+        nodata=nodata,
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress="deflate",
+    ) as dst:
+        dst.write(datos, 1)
+
+
+def generar_bucket_sintetico(root, tiles, meses, indices, tile_px, seed=0):
+    """
+    Puebla ``root`` con composites sintéticos: un GeoTIFF por índice y por banda
+    RGB para cada tesela y mes. Los ficheros existentes no se regeneran.
+
+    Args:
+        root (str): Directorio raíz del almacén local (una carpeta por bucket).
+        tiles (int): Número de teselas UTM.
+        meses (list): Pares (año, mes en inglés).
+        indices (list): Índices a generar (p. ej. ["ndvi"]).
+        tile_px (int): Lado de cada tesela en píxeles.
+        seed (int): Semilla del generador aleatorio.
+
+    Returns:
+        dict: Huellas de las teselas generadas.
+    """
+    rng = np.random.default_rng(seed)
+    huellas = huellas_tiles(tiles)
+    resolucion = LADO_TILE / tile_px
+    # Un gradiente suave más ruido se comprime como una imagen real, no como ruido puro.
+    gradiente = np.add.outer(np.linspace(0, 1, tile_px), np.linspace(0, 1, tile_px)) / 2
+
+    for (zona, (left, _, _, top)), (year, month) in product(huellas.items(), meses):
+        prefijo = f"{zona}/{year}/{month}/composites"
+        for indice in indices:
+            ruta = os.path.join(root, BUCKET_INDICES, prefijo, "indexes", f"{indice}.tif")
+            if not os.path.exists(ruta):
+                ruido = rng.normal(0, 0.05, (tile_px, tile_px))
+                datos = (gradiente * 1.6 - 0.6 + ruido).astype("float32")
+                _escribir_tif(ruta, datos, left, top, resolucion, np.nan)
+        for banda in BANDAS_RGB:
+            ruta = os.path.join(root, BUCKET_RAW, prefijo, "raw", f"{banda}.tif")
+            if not os.path.exists(ruta):
+                ruido = rng.normal(0, 150, (tile_px, tile_px))
+                datos = np.clip(gradiente * 3000 + 500 + ruido, 1, 10000).astype("uint16")
+                _escribir_tif(ruta, datos, left, top, resolucion, 0)
+    return huellas
+
+
+def aoi_sintetica(huellas):
+    """
+    AOI en EPSG:4326 que va del centro de la primera tesela al de la última,
+    de modo que toca todas y obliga a fusionarlas.
+    """
+    centros = [((l + r) / 2, (b + t) / 2) for l, b, r, t in huellas.values()]
+    xs, ys = zip(*centros)
+    margen = 2500
+    aoi = box(min(xs) - margen, min(ys) - margen, max(xs) + margen, max(ys) + margen)
+    return gpd.GeoDataFrame({"id": ["aoi"]}, geometry=[aoi], crs=CRS_TILES).to_crs("EPSG:4326")
+
+
+def preparar_entrada(entrada, gdf, carpeta):
+    """
+    Escribe la AOI en el formato que espera cada ``process_*_sentinel``.
+    """
+    if entrada == "geojson":
+        ruta = os.path.join(carpeta, "aoi.geojson")
+        gdf.to_file(ruta, driver="GeoJSON")
+        return ruta
+    if entrada == "csv":
+        ruta = os.path.join(carpeta, "aoi.csv")
+        x, y = gdf.geometry.iloc[0].exterior.coords.xy
+        with open(ruta, "w") as f:
+            f.write("lat,lon\n")
+            for lon, lat in list(zip(x, y))[:-1]:
+                f.write(f"{lat},{lon}\n")
+        return ruta
+    if entrada == "shp":
+        carpeta_shp = os.path.join(carpeta, "shp")
+        os.makedirs(carpeta_shp, exist_ok=True)
+        gdf.to_file(os.path.join(carpeta_shp, "aoi.shp"))
+        ruta = os.path.join(carpeta, "aoi.zip")
+        with zipfile.ZipFile(ruta, "w") as zf:
+            for nombre in os.listdir(carpeta_shp):
+                zf.write(os.path.join(carpeta_shp, nombre), nombre)
+        return ruta
+    raise ValueError(f"Entrada no soportada: {entrada}")
+
+
+def ejecutar(args):
+    # La configuración se lee al importar los módulos de la aplicación, así que
+    # el entorno se fija antes de importarlos.
+    root = os.path.abspath(args.root)
+    trabajo = tempfile.mkdtemp(prefix="benchmark_")
+    os.environ["MINIO_LOCAL_ROOT"] = root
+    os.environ["bucket_name"] = BUCKET_RAW
+    os.environ.setdefault("MANIFEST_PATH", os.path.join(trabajo, "manifest.db"))
+    os.environ.setdefault("TILE_CACHE_DIR", os.path.join(trabajo, "tile_cache"))
+    os.environ.setdefault("MERGE_CACHE_DIR", os.path.join(trabajo, "merge_cache"))
+
+    meses = meses_entre(args.desde, args.hasta)
+    indices = [] if args.indice.upper() == "RGB" else [args.indice.lower()]
+    inicio = time.perf_counter()
+    huellas = generar_bucket_sintetico(root, args.tiles, meses, indices, args.tile_px)
+    print(f"🧪 Bucket sintético listo en {time.perf_counter() - inicio:.1f}s: {root}")
+
+    from app import interface
+
+    tiles = gpd.GeoDataFrame(
+        {"Name": list(huellas)},
+        geometry=[box(*huella) for huella in huellas.values()],
+        crs=CRS_TILES,
+    ).to_crs("EPSG:4326")
+
+    def get_tiles_polygons(gdf):
+        # Sustituye al KML de la rejilla Sentinel-2 por las teselas sintéticas.
+        return set(gpd.sjoin(tiles, gdf.to_crs(tiles.crs), predicate="intersects")["Name"])
+
+    interface.get_tiles_polygons = get_tiles_polygons
+    funciones = {
+        "geojson": interface.process_geojson_data_sentinel,
+        "shp": interface.process_shp_data_sentinel,
+        "csv": interface.process_csv_data_sentinel,
+    }
+
+    gdf = aoi_sintetica(huellas)
+    ruta = preparar_entrada(args.entrada, gdf, trabajo)
+    date_start = datetime.strptime(args.desde, "%Y-%m")
+    date_end = datetime.strptime(args.hasta, "%Y-%m")
+    extra = ("lat", "lon") if args.entrada == "csv" else ()
+
+    tiempos = []
+    for repeticion in range(args.repeticiones):
+        if args.en_frio:
+            shutil.rmtree(os.environ["TILE_CACHE_DIR"], ignore_errors=True)
+            shutil.rmtree(os.environ["MERGE_CACHE_DIR"], ignore_errors=True)
+            if os.path.exists(os.environ["MANIFEST_PATH"]):
+                os.remove(os.environ["MANIFEST_PATH"])
+            from app import manifest, merge_cache, tile_cache
+            manifest._manifest = None
+            tile_cache._tile_cache = None
+            merge_cache._merge_cache = None
+        inicio = time.perf_counter()
+        resultado = funciones[args.entrada](ruta, args.indice, date_start, date_end, *extra)
+        tiempos.append(time.perf_counter() - inicio)
+        print(f"⏱️ Ejecución {repeticion + 1}: {tiempos[-1]:.2f}s -> {resultado[0]}")
+
+    resumen = {
+        "entrada": args.entrada,
+        "indice": args.indice,
+        "tiles": args.tiles,
+        "meses": len(meses),
+        "tile_px": args.tile_px,
+        "en_frio": args.en_frio,
+        "tiempos": [round(t, 3) for t in tiempos],
+        "mediana": round(float(np.median(tiempos)), 3),
+    }
+    print(json.dumps(resumen, ensure_ascii=False))
+    return resumen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default=os.path.join(tempfile.gettempdir(), "bucket_sintetico"))
+    parser.add_argument("--tiles", type=int, default=2)
+    parser.add_argument("--tile-px", type=int, default=1098)
+    parser.add_argument("--desde", default="2023-01")
+    parser.add_argument("--hasta", default="2023-03")
+    parser.add_argument("--indice", default="ndvi")
+    parser.add_argument("--entrada", choices=["geojson", "shp", "csv"], default="geojson")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument(
+        "--en-frio",
+        action="store_true",
+        help="Vacía las cachés de teselas y de mosaicos y el manifiesto antes de cada ejecución.",
+    )
+    ejecutar(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
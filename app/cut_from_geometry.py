@@ -1,12 +1,53 @@
 import os
-import tempfile
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
+from dotenv import load_dotenv
+from rasterio.enums import MaskFlags
+from rasterio.mask import mask, raster_geometry_mask
 from shapely.geometry import shape
 
+from app.raster_io import en_ambito, intermediate_path, write_raster
+
+
+load_dotenv()
+
+# Rasters que ``cut_from_geometries`` recorta a la vez (uno por hilo).
+CUT_MAX_WORKERS = int(os.getenv("CUT_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+def cut_window(src, geometries):
+    """Cuts ``src`` by ``geometries`` reading only the window they cover.
+
+    Same result as ``rasterio.mask.mask(src, geometries, crop=True)``: the window
+    comes from the geometry bounds and the geometry mask is rasterised only for
+    that window. The window is read without the dataset mask band, since with a
+    nodata value (or no mask at all) it would only mark pixels that are already
+    nodata; datasets with other masks (alpha, per-dataset) go through ``mask``.
+
+    Args:
+        src (rasterio.io.DatasetReader): Open raster, in the CRS of the geometries.
+        geometries (list): Geometries to cut by.
+
+    Returns:
+        tuple: Cropped array (bands, rows, cols) and its affine transform.
+
+    Raises:
+        ValueError: If the geometries do not overlap the raster.
+    """
+    if any(
+        set(flags) - {MaskFlags.all_valid, MaskFlags.nodata}
+        for flags in src.mask_flag_enums
+    ):
+        return mask(src, geometries, crop=True)
+
+    outside, transform, window = raster_geometry_mask(src, geometries, crop=True)
+    out_image = src.read(window=window, out_shape=(src.count,) + outside.shape)
+    out_image[:, outside] = src.nodata if src.nodata is not None else 0
+    return out_image, transform
+
 
 def save_raster(image, temp_file, src, transform, format):
     """Saves a raster image to a temporary file.
@@ -23,9 +64,14 @@ def save_raster(image, temp_file, src, transform, format):
     """
     try:
         out_meta = src.meta.copy()
+        if format == "tif":
+            # GeoTIFF teselado y comprimido (COG por defecto), ver app.raster_io.
+            out_meta.update({"transform": transform})
+            write_raster(temp_file, image, out_meta)
+            return
         out_meta.update(
             {
-                "driver": "GTiff" if format == "tif" else "JP2OpenJPEG",
+                "driver": "JP2OpenJPEG",
                 "height": image.shape[1],
                 "width": image.shape[2],
                 "transform": transform,
@@ -42,7 +88,7 @@ def cut_from_geometry(gdf_parcela, format, image_paths, geometry_id):
 
     Args:
         gdf_parcela (GeoDataFrame or dict): GeoDataFrame containing the geometry, or a dictionary representing the parcel geometry.
-        format (str): Format for output raster files, e.g., 'tif' or 'jp2'.
+        format (str): Format for output raster files, e.g., 'tif' or 'jp2'. 'vrt' mosaics are cut to 'tif'.
         image_paths (list of str): List of paths to raster files to be cut.
 
     Returns:
@@ -69,8 +115,6 @@ def cut_from_geometry(gdf_parcela, format, image_paths, geometry_id):
             raise FileNotFoundError(f"No files found with the .{format} format.")
 
         for image_path in valid_files:
-            original_filename = os.path.basename(image_path)
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")[:-3]
             with rasterio.open(image_path) as src:
                 gdf_parcela = gdf_parcela.to_crs(src.crs)
                 if gdf_parcela.is_empty.any():
@@ -78,12 +122,12 @@ def cut_from_geometry(gdf_parcela, format, image_paths, geometry_id):
                     continue
 
                 geometries = [gdf_parcela.geometry.iloc[0]]
-                out_image, out_transform = mask(src, geometries, crop=True)
-                extension = format.lower()
-                filename = original_filename.replace(".tif", f"_{geometry_id}.{extension}").replace(".jp2", f"_{geometry_id}.{extension}")
-                temp_file = os.path.join(tempfile.gettempdir(), filename)
+                out_image, out_transform = cut_window(src, geometries)
+                # Los mosaicos VRT se recortan a GeoTIFF.
+                extension = "tif" if format.lower() == "vrt" else format.lower()
+                temp_file = _cut_name(image_path, geometry_id, extension)
 
-                save_raster(out_image, temp_file, src, out_transform, format)
+                save_raster(out_image, temp_file, src, out_transform, extension)
                 cropped_images.append(temp_file)
 
         return cropped_images
@@ -94,3 +138,102 @@ def cut_from_geometry(gdf_parcela, format, image_paths, geometry_id):
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         raise
+
+
+def geometries_to_gdf(geometries):
+    """Builds a GeoDataFrame from GeoJSON-like geometry dictionaries.
+
+    The CRS is taken from the ``CRS`` key of the first geometry, defaulting to
+    EPSG:4326, as ``cut_from_geometry`` does for a single geometry.
+
+    Args:
+        geometries (list of dict): Geometry dictionaries.
+
+    Returns:
+        GeoDataFrame: One row per geometry, in the same order.
+    """
+    crs = geometries[0].get("CRS", {"init": "epsg:4326"}) if geometries else None
+    return gpd.GeoDataFrame(geometry=[shape(g) for g in geometries], crs=crs)
+
+
+def _cut_name(image_path, geometry_id, extension):
+    original_filename = os.path.basename(image_path)
+    filename = original_filename.replace(".tif", f"_{geometry_id}.{extension}").replace(".jp2", f"_{geometry_id}.{extension}").replace(".vrt", f"_{geometry_id}.{extension}")
+    return intermediate_path(filename)
+
+
+def cut_from_geometries(gdf, format, image_paths, geometry_ids, max_workers=CUT_MAX_WORKERS):
+    """Cuts every raster by every feature of a GeoDataFrame.
+
+    Each raster is opened once for all the features, and the features are
+    reprojected once per raster CRS instead of once per raster and feature.
+    Rasters are cut in parallel on up to ``max_workers`` threads.
+
+    Args:
+        gdf (GeoDataFrame): Features to cut by.
+        format (str): Format of the rasters to cut, e.g. 'tif', 'jp2' or 'vrt' ('vrt' mosaics are cut to 'tif').
+        image_paths (list of str): List of paths to raster files to be cut.
+        geometry_ids (list): Identifier of each feature, used in the output file names.
+        max_workers (int): Maximum number of rasters cut at the same time.
+
+    Returns:
+        list: One list per feature, in the order of ``gdf``, with the paths of its
+        cropped rasters in the order of ``image_paths`` (the same output as calling
+        ``cut_from_geometry`` for each feature).
+
+    Raises:
+        FileNotFoundError: If no raster files match the format.
+        ValueError: If ``geometry_ids`` has duplicates.
+        Exception: For other errors during the cutting process.
+    """
+    valid_files = [f for f in image_paths if f.endswith(f".{format}")]
+    if not valid_files:
+        message = f"No files found with the .{format} format."
+        print(message)
+        raise FileNotFoundError(message)
+    # Los mosaicos VRT se recortan a GeoTIFF.
+    extension = "tif" if format.lower() == "vrt" else format.lower()
+    geometry_ids = list(geometry_ids)
+    # Los recortes se nombran con el identificador: dos iguales se pisarían.
+    if len(set(geometry_ids)) != len(geometry_ids):
+        raise ValueError("geometry_ids must be unique: crops are named after them.")
+
+    reprojected = {}
+    reprojected_lock = threading.Lock()
+
+    def geometries_in(crs):
+        # Las geometrías se reproyectan una sola vez por CRS de los rasters.
+        key = crs.to_wkt() if crs else None
+        with reprojected_lock:
+            if key not in reprojected:
+                reprojected[key] = list(gdf.to_crs(crs).geometry) if crs else list(gdf.geometry)
+            return reprojected[key]
+
+    def cut_image(image_path):
+        cropped = [None] * len(geometry_ids)
+        with rasterio.open(image_path) as src:
+            for i, (geometry, geometry_id) in enumerate(zip(geometries_in(src.crs), geometry_ids)):
+                if geometry is None or geometry.is_empty:
+                    print(f"Parcel geometry is empty for image {image_path}.")
+                    continue
+                out_image, out_transform = cut_window(src, [geometry])
+                temp_file = _cut_name(image_path, geometry_id, extension)
+                save_raster(out_image, temp_file, src, out_transform, extension)
+                cropped[i] = temp_file
+        return cropped
+
+    try:
+        workers = max(1, min(max_workers, len(valid_files)))
+        if workers == 1:
+            per_image = [cut_image(image_path) for image_path in valid_files]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cut") as executor:
+                per_image = list(executor.map(en_ambito(cut_image), valid_files))
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        raise
+
+    return [
+        [cropped[i] for cropped in per_image if cropped[i] is not None]
+        for i in range(len(geometry_ids))
+    ]
@@ -1,50 +1,88 @@
 import os
-import tempfile
-from concurrent.futures import ThreadPoolExecutor
 
 import rasterio
 from dotenv import load_dotenv
-from minio import Minio
-from minio.error import S3Error
-from rasterio.merge import merge
-from rasterio.warp import calculate_default_transform, reproject
-import shutil
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+
+from app.manifest import get_manifest, periodo
+from app.merge_cache import buscar_producto, fusionar_grupos
+from app.merge_pool import MERGE_MAX_WORKERS
+from app.mosaic import AOIFueraDeImagenes, merge_bounds, merge_por_bloques, write_vrt_mosaic
+from app.raster_io import carpeta_temporal
+from app.remote_read import FUERA_DEL_AOI, VENTANA_LEIDA, read_window, remote_read_enabled
+from app.storage import TransferJob, get_minio_client
+from app.tile_cache import get_tile_cache
 
 
 load_dotenv()
 
-MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
-MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
-MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
+# Hilos del warper de GDAL para reproyectar teselas de otra zona UTM ("ALL_CPUS" o
+# un número), a repartir entre las fusiones que corren a la vez en el pool.
+WARP_NUM_THREADS = os.getenv("WARP_NUM_THREADS", "ALL_CPUS")
+# Memoria máxima (MB) de cada trozo que procesa el warper.
+WARP_MEM_LIMIT_MB = int(os.getenv("WARP_MEM_LIMIT_MB", "256"))
+
+BUCKET_NAME = "test-am-products"
 
 
-def download_tif_file(client, bucket_name, obj, download_dir):
+def download_tif_file(client, bucket_name, obj, download_dir, aoi_bounds=None):
     original_file_name = obj.object_name.split("/")[-1]
     unique_file_name = f"{obj.object_name.split('/')[0]}_{original_file_name}"
     local_file_path = os.path.join(download_dir, unique_file_name)
     print("LOCAL EN DOWNLOAD",local_file_path)
 
-    if not os.path.exists(local_file_path):
-        client.fget_object(bucket_name, obj.object_name, local_file_path)
+    if os.path.exists(local_file_path):
+        return local_file_path
+
+    cache = get_tile_cache()
+    if remote_read_enabled(aoi_bounds) and not cache.contains(
+        bucket_name, obj.object_name, obj.etag
+    ):
+        try:
+            lectura = read_window(bucket_name, obj.object_name, aoi_bounds, local_file_path)
+            if lectura == VENTANA_LEIDA:
+                return local_file_path
+            if lectura == FUERA_DEL_AOI:
+                # La tesela no aporta nada al mosaico del AOI.
+                return None
+        except Exception as e:
+            print(f"⚠️ Lectura remota fallida para {obj.object_name}, se descarga completo: {e}")
+
+    cache.fetch(client, bucket_name, obj, local_file_path)
     return local_file_path
 
 
-def parallel_download(client, bucket_name, download_tasks):
+def parallel_download(client, bucket_name, download_tasks, aoi_bounds=None):
+    """
+    Descarga en paralelo los objetos de ``download_tasks`` (pares objeto, carpeta),
+    que se consume a medida que se generan.
+
+    Returns:
+        Tuple[list, set]: Rutas descargadas y carpetas a las que les falta algún
+        objeto tras agotar los reintentos (no deben fusionarse).
+    """
     downloaded_files = []
+    carpetas_incompletas = set()
 
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(download_tif_file, client, bucket_name, obj, download_dir)
+    with TransferJob() as job:
+        futures = {
+            job.submit(
+                download_tif_file, client, bucket_name, obj, download_dir, aoi_bounds
+            ): download_dir
             for obj, download_dir in download_tasks
-        ]
-        print(futures)
-        for future in futures:
+        }
+        for future, download_dir in futures.items():
             try:
-                downloaded_files.append(future.result())
+                ruta = future.result()
+                if ruta:
+                    downloaded_files.append(ruta)
             except Exception as e:
                 print(f"Error descargando archivo: {e}")
-        print(downloaded_files)
-    return downloaded_files
+                carpetas_incompletas.add(download_dir)
+    return downloaded_files, carpetas_incompletas
 
 
 def get_months_for_year(year, start_year, start_month, end_year, end_month):
@@ -80,7 +118,21 @@ def get_months_for_year(year, start_year, start_month, end_year, end_month):
         return all_months
 
 
-def download_tif_files(utm_zones, years, indexes, months):
+def rango_year_months(years, months):
+    """
+    Devuelve la lista ordenada de pares (año, mes en inglés) entre el mes y año
+    inicial y el mes y año final, ambos incluidos.
+    """
+    return [
+        (year, month)
+        for year in range(int(years[0]), int(years[1]) + 1)
+        for month in get_months_for_year(
+            str(year), years[0], months[0], years[1], months[1]
+        )
+    ]
+
+
+def download_tif_files(utm_zones, years, indexes, months, aoi_bounds=None):
     """
     Descarga imágenes TIFF desde MinIO, las organiza por año, índice y mes,
     y opcionalmente fusiona las imágenes de cada mes en un único archivo.
@@ -90,71 +142,69 @@ def download_tif_files(utm_zones, years, indexes, months):
         years (list): Lista de años a descargar.
         indexes (list): Lista de índices (como NDVI, NDWI) a incluir.
         months (list): Lista con el mes inicial y final (e.g., ["March", "June"]).
+        aoi_bounds (tuple, optional): Límites (minx, miny, maxx, maxy) del área de
+            interés en EPSG:4326. Si se indica, sólo se lee de cada composite la
+            ventana que cubre el AOI.
 
     Returns:
         list: Lista de rutas de las imágenes TIFF fusionadas.
     """
-    local_download_path = tempfile.mkdtemp()
-    bucket_name = "test-am-products"
+    local_download_path = carpeta_temporal()
+    bucket_name = BUCKET_NAME
     tiff_paths = []
 
-    client = Minio(
-        endpoint=MINIO_ENDPOINT,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=False,
+    client = get_minio_client()
+
+    year_months = rango_year_months(years, months)
+    manifest = get_manifest()
+
+    def carpeta_de(grupo):
+        year, month_number, index = grupo
+        return os.path.join(local_download_path, str(year), index, month_number)
+
+    def ruta_de(grupo):
+        year, month_number, index = grupo
+        return os.path.join(carpeta_de(grupo), f"{index}_{year}_{month_number}.tif")
+
+    claves, servidos = {}, {}
+
+    def tareas_descarga():
+        # Cada grupo se busca en la caché en cuanto su mes está listado, y sus
+        # descargas empiezan mientras sigue el listado de los demás meses. Los
+        # meses ya fusionados por otra petición no se vuelven a descargar.
+        for grupo, objetos in manifest.iter_grupos(
+            client,
+            bucket_name,
+            utm_zones,
+            year_months,
+            "indexes",
+            indexes,
+            lambda obj: (obj.year, convertir_mes_a_numero(obj.month), obj.name.upper()),
+        ):
+            claves[grupo], servidos[grupo] = buscar_producto(
+                bucket_name, grupo, objetos, aoi_bounds, ruta_de(grupo)
+            )
+            if servidos[grupo]:
+                continue
+            os.makedirs(carpeta_de(grupo), exist_ok=True)
+            for obj in objetos:
+                yield obj, carpeta_de(grupo)
+
+    _, carpetas_incompletas = parallel_download(
+        client, bucket_name, tareas_descarga(), aoi_bounds
     )
 
-    download_tasks = []
-    valid_utm_zones = []
-
+    zonas_con_datos = manifest.available_zones(
+        bucket_name, utm_zones, periodo(*year_months[0]), periodo(*year_months[-1])
+    )
+    valid_utm_zones = [zone for zone in utm_zones if zone in zonas_con_datos]
     for zone in utm_zones:
-        has_data = False
-        for year in range(int(years[0]), int(years[1]) + 1):
-            applicable_months = get_months_for_year(
-                str(year), years[0], months[0], years[1], months[1]
-            )
-            for month_folder in applicable_months:
-                composites_path = f"{zone}/{year}/{month_folder}/composites/"
-                try:
-                    objects_list = list(client.list_objects(
-                        bucket_name, prefix=composites_path, recursive=True
-                    ))
-
-                    if not objects_list:
-                        continue 
-
-                    has_data = True  
-
-                    for obj in objects_list:
-                        if (
-                            obj.object_name.endswith(".tif")
-                            and "indexes" in obj.object_name
-                        ):
-                            file_parts = obj.object_name.split("/")
-                            index_name = file_parts[-1].split(".")[0].upper()
-                            if index_name in indexes:
-                                month_number = convertir_mes_a_numero(month_folder)
-                                download_dir = os.path.join(
-                                    local_download_path,
-                                    str(year),
-                                    index_name,
-                                    str(month_number),
-                                )
-                                os.makedirs(download_dir, exist_ok=True)
-                                download_tasks.append((obj, download_dir))
-                except S3Error as exc:
-                    print(f"裡 S3Error al acceder a {composites_path}: {exc}")
-                except Exception as e:
-                    print(f"❌ Error inesperado accediendo a {composites_path}: {e}")
-
-        if has_data:
-            valid_utm_zones.append(zone)
+        if zone in zonas_con_datos:
             print(f"✅ Zona UTM válida: '{zone}'")
         else:
             print(f"⚠️ No se encontraron datos para la zona UTM '{zone}', se omitirá.")
 
-    parallel_download(client, bucket_name, download_tasks)
+    tareas_merge, rutas_grupo = [], {}
     for year in range(int(years[0]), int(years[1]) + 1):
         applicable_months = get_months_for_year(
             str(year), years[0], months[0], years[1], months[1]
@@ -165,64 +215,105 @@ def download_tif_files(utm_zones, years, indexes, months):
                 carpeta_mes = os.path.join(
                     local_download_path, str(year), index, month_number
                 )
+                grupo = (index, year, month_number)
+                en_cache = (year, month_number, index)
 
 
-                if os.path.exists(carpeta_mes):
+                if servidos.get(en_cache):
+                    rutas_grupo[grupo] = servidos[en_cache]
+                elif carpeta_mes in carpetas_incompletas:
+                    print(f"❌ Faltan objetos de {carpeta_mes}, no se fusiona un mes incompleto.")
+                elif os.path.exists(carpeta_mes):
                     merge_path = os.path.join(
                         carpeta_mes, f"{index}_{year}_{month_number}.tif"
                     )
-                    if merge_tifs(carpeta_mes, merge_path):
-                        print(f"✅ TIFF fusionado: {merge_path}")
-                        tiff_paths.append(merge_path)
-                    else:
-                        print(f"❌ No se pudo fusionar TIFFs en: {carpeta_mes}")
+                    tareas_merge.append((
+                        grupo,
+                        (carpeta_mes, merge_path, 4326, aoi_bounds),
+                        claves.get(en_cache),
+                        merge_path,
+                    ))
+                    rutas_grupo[grupo] = None
                 else:
                     print(f"⚠️ Carpeta no encontrada: {carpeta_mes}")
 
+    # Cada (índice, año, mes) se fusiona en paralelo; el orden de salida es el de los bucles.
+    for grupo, merge_path in fusionar_grupos(merge_tifs, tareas_merge):
+        rutas_grupo[grupo] = merge_path
+
+    for (index, year, month_number), merge_path in rutas_grupo.items():
+        if merge_path:
+            print(f"✅ TIFF fusionado: {merge_path}")
+            tiff_paths.append(merge_path)
+        else:
+            print(f"❌ No se pudo fusionar TIFFs del grupo {index} {year}-{month_number}")
+
     print(f" Zonas UTM procesadas: {valid_utm_zones}")
     return tiff_paths
 
-def reproyectar_tif(tif_path, destino_crs, salida_path):
+def hilos_warp(total=WARP_NUM_THREADS, fusiones=MERGE_MAX_WORKERS):
+    """
+    Hilos del warper para una fusión: los ``total`` (``ALL_CPUS`` son todas las
+    CPU) repartidos entre las ``fusiones`` que el pool ejecuta a la vez, para
+    que cada proceso no lance un hilo por CPU.
     """
-    Reproyecta un archivo TIFF a un CRS específico.
+    total = (os.cpu_count() or 1) if total == "ALL_CPUS" else int(total)
+    return max(1, total // max(1, fusiones))
+
+
+def reproyectar_tif(
+    tif_path,
+    destino_crs,
+    salida_path,
+    num_threads=None,
+    warp_mem_limit=WARP_MEM_LIMIT_MB,
+):
+    """
+    Prepara un archivo TIFF para usarlo en un CRS específico. Si ya está en ese CRS
+    se usa tal cual, sin copiarlo; si no, se escribe en ``salida_path`` un VRT de
+    reproyección (``WarpedVRT``) que GDAL calcula al leer, en lugar de un TIFF nuevo.
+
+    El VRT guarda las opciones del warper: GDAL reproyecta cada lectura por
+    trozos de como mucho ``warp_mem_limit`` MB y con ``num_threads`` hilos (por
+    defecto, ``hilos_warp()``).
+
+    Returns:
+        str | None: Ruta a usar en la fusión, o None si ha fallado.
     """
+    if num_threads is None:
+        num_threads = hilos_warp()
     try:
         with rasterio.open(tif_path) as src:
-            if src.crs.to_epsg() == destino_crs:
-                shutil.copy(tif_path, salida_path)
-                return True 
-            else:
-                transform, width, height = calculate_default_transform(
-                    src.crs, destino_crs, src.width, src.height, *src.bounds
-                )
-                profile = src.profile.copy()
-                profile.update({
-                    'crs': destino_crs,
-                    'transform': transform,
-                    'width': width,
-                    'height': height
-                })
-
-                with rasterio.open(salida_path, 'w', **profile) as dst:
-                    for i in range(1, src.count + 1):
-                        reproject(
-                            source=rasterio.band(src, i),
-                            destination=rasterio.band(dst, i),
-                            src_transform=src.transform,
-                            src_crs=src.crs,
-                            dst_transform=transform,
-                            dst_crs=destino_crs,
-                            resampling=rasterio.enums.Resampling.nearest
-                        )
-                print(f"✅ Reproyectado TIFF {tif_path} a {destino_crs}")
-                return True
+            if src.crs == destino_crs:
+                return tif_path
+            transform, width, height = calculate_default_transform(
+                src.crs, destino_crs, src.width, src.height, *src.bounds
+            )
+            with WarpedVRT(
+                src,
+                crs=destino_crs,
+                transform=transform,
+                width=width,
+                height=height,
+                resampling=Resampling.nearest,
+                warp_mem_limit=warp_mem_limit,
+                NUM_THREADS=num_threads,
+            ) as vrt:
+                rasterio.shutil.copy(vrt, salida_path, driver="VRT")
+            print(f"✅ Reproyectado TIFF {tif_path} a {destino_crs}")
+            return salida_path
     except Exception as e:
         print(f"❌ Error reproyectando TIFF {tif_path}: {e}")
-        return False
+        return None
 
-def merge_tifs(carpeta_entrada, salida_path, destino_crs=4326):
+def merge_tifs(carpeta_entrada, salida_path, destino_crs=4326, aoi_bounds=None):
     """
     Fusiona archivos TIFF en una carpeta en un único archivo TIFF. Reproyecta los TIFFs al CRS destino antes de fusionar.
+    Con ``MOSAIC_MODE=vrt`` el mosaico es un VRT junto a ``salida_path`` en lugar de un GeoTIFF.
+    Si se indica ``aoi_bounds`` (EPSG:4326), el mosaico cubre sólo la zona del AOI.
+
+    Returns:
+        str | bool: Ruta del mosaico (GeoTIFF o VRT), o False si no se pudo fusionar.
     """
     imagenes_tif = [
         os.path.join(carpeta_entrada, f)
@@ -239,14 +330,23 @@ def merge_tifs(carpeta_entrada, salida_path, destino_crs=4326):
 
     reproyectados = []
     for tif in imagenes_tif:
-        tif_reproyectado = tif.replace(".tif", f"_reproyectado.tif")
-        if reproyectar_tif(tif, crs_ref, tif_reproyectado):
+        tif_reproyectado = reproyectar_tif(tif, crs_ref, tif.replace(".tif", "_reproyectado.vrt"))
+        if tif_reproyectado:
             reproyectados.append(tif_reproyectado)
 
     if len(reproyectados) < 1:
         print("❌ No se pudieron reproyectar las imágenes.")
         return False
 
+    try:
+        vrt_path = write_vrt_mosaic(reproyectados, salida_path, aoi_bounds=aoi_bounds)
+    except AOIFueraDeImagenes as e:
+        print(f"⚠️ {e} de {carpeta_entrada}; no hay mosaico.")
+        return False
+    if vrt_path:
+        print(f"✅ Mosaico virtual creado: {vrt_path}")
+        return vrt_path
+
     datasets = []
     for imagen in reproyectados:
         try:
@@ -262,23 +362,16 @@ def merge_tifs(carpeta_entrada, salida_path, destino_crs=4326):
 
     try:
         print(f"⚙️ Fusionando {len(datasets)} archivos TIFF...")
-        merged, output_transform = merge(datasets, method="last")
-
-        perfil = datasets[0].profile
-        perfil.update(
-            driver="GTiff",
-            height=merged.shape[1],
-            width=merged.shape[2],
-            transform=output_transform,
-            count=datasets[0].count,
-            dtype=merged.dtype,
+        merge_por_bloques(
+            datasets, salida_path, bounds=merge_bounds(datasets, aoi_bounds), method="last"
         )
 
-        with rasterio.open(salida_path, "w", **perfil) as dst:
-            dst.write(merged)
-
         print(f"✅ Fusión completada: {salida_path}")
-        return True
+        return salida_path
+
+    except AOIFueraDeImagenes as e:
+        print(f"⚠️ {e} de {carpeta_entrada}; no hay mosaico.")
+        return False
 
     except Exception as e:
         print(f"❌ Error durante la fusión de TIFFs en {carpeta_entrada}: {e}")
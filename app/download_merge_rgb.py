@@ -1,36 +1,31 @@
 import os
+import shutil
 import rasterio
 import numpy as np
 import cv2
 from PIL import Image
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from tempfile import TemporaryDirectory
-from minio import Minio
-from minio.error import S3Error
+from concurrent.futures import as_completed
 import tempfile
 from dotenv import load_dotenv
 from PIL import Image, ImageDraw, ImageFont
-from app.generate_map import merge_tifs_por_fecha
+from app.generate_map import merge_grupo, merge_tifs_por_fecha
 from collections import defaultdict
-from rasterio.merge import merge
+from app.manifest import get_manifest
+from app.merge_cache import buscar_producto, fusionar_grupos
+from app.merge_pool import map_grupos
+from app.mosaic import AOIFueraDeImagenes, merge_bounds, merge_por_bloques, write_vrt_mosaic
+from app.raster_io import carpeta_temporal, intermediate_path, intermedios_en_memoria, write_raster
+from app.remote_read import SIN_TESELAR, read_window, remote_read_enabled
+from app.storage import TransferJob, get_minio_client
+from app.tile_cache import get_tile_cache
 
 
 load_dotenv()
 
-MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
-MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
-MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 bucket_name = os.getenv("bucket_name")
 
-client = Minio(
-    endpoint=MINIO_ENDPOINT,
-    access_key=MINIO_ACCESS_KEY,
-    secret_key=MINIO_SECRET_KEY,
-    secure=False,
-)
-
 
 
 def convertir_mes_a_numero(nombre_mes):
@@ -45,64 +40,133 @@ def generar_rango_fechas(years, months):
         start_date += relativedelta(months=1)
     return fechas
 
-def descargar_archivo(client, obj, local_file_path):
-    client.fget_object(bucket_name, obj.object_name, local_file_path)
-
-def merge_tifs(input_dir, year, banda, month_number):
+def descargar_archivo(client, obj, local_file_path, aoi_bounds=None):
+    cache = get_tile_cache()
+    if remote_read_enabled(aoi_bounds) and not cache.contains(
+        bucket_name, obj.object_name, obj.etag
+    ):
+        try:
+            # Si el AOI no toca la tesela, no hace falta ni la ventana ni el objeto.
+            if read_window(bucket_name, obj.object_name, aoi_bounds, local_file_path) != SIN_TESELAR:
+                return
+        except Exception as e:
+            print(f"Lectura remota fallida para {obj.object_name}, se descarga completo: {e}")
+    cache.fetch(client, bucket_name, obj, local_file_path)
+
+def ruta_merge(input_dir, year, banda, month_number):
+    # Junto a las descargas de la petición ({year}/{banda}/{mes}), no en una ruta
+    # fija que otra petición concurrente podría sobrescribir.
+    return os.path.join(os.path.dirname(input_dir), f"RGB_{year}_{month_number}_{banda}.tif")
+
+def merge_tifs(input_dir, year, banda, month_number, aoi_bounds=None):
     archivos = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(".tif")]
     if not archivos:
         return None
-    mosaico, out_transform = rasterio.merge.merge([rasterio.open(f) for f in archivos])
-    out_meta = rasterio.open(archivos[0]).meta.copy()
-    out_meta.update({
-        "driver": "GTiff",
-        "height": mosaico.shape[1],
-        "width": mosaico.shape[2],
-        "transform": out_transform
-    })
-    salida_path = f"data/merge/{year}/{banda}"
-    os.makedirs(salida_path, exist_ok=True)
-    merge_path = f"{salida_path}/RGB_{year}_{month_number}_{banda}.tif"
-    with rasterio.open(merge_path, "w", **out_meta) as dest:
-        dest.write(mosaico)
-    return merge_path
-
-def descargar_archivos_tif(utm_zones, years, months):
+    merge_path = ruta_merge(input_dir, year, banda, month_number)
+    try:
+        vrt_path = write_vrt_mosaic(archivos, merge_path, method="first", aoi_bounds=aoi_bounds)
+    except AOIFueraDeImagenes as e:
+        print(f"⚠️ {e} de {input_dir}; no hay mosaico.")
+        return None
+    if vrt_path:
+        return vrt_path
+    datasets = []
+    try:
+        for f in archivos:
+            datasets.append(rasterio.open(f))
+        bounds = merge_bounds(datasets, aoi_bounds)
+        return merge_por_bloques(datasets, merge_path, bounds=bounds, method="first")
+    except AOIFueraDeImagenes as e:
+        print(f"⚠️ {e} de {input_dir}; no hay mosaico.")
+        return None
+    finally:
+        for ds in datasets:
+            ds.close()
+
+def descargar_archivos_tif(utm_zones, years, months, aoi_bounds=None):
     year_month_pairs = generar_rango_fechas(years, months)
     bandas = ["B02_20m", "B03_20m", "B04_20m"]
     rutas_mergeadas = []
 
-    with TemporaryDirectory() as local_download_path:
-        download_tasks = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            for zone in utm_zones:
-                for year, month_folder in year_month_pairs:
-                    composites_path = f"{zone}/{year}/{month_folder}/composites/"
-                    try:
-                        objects = client.list_objects(bucket_name, prefix=composites_path, recursive=True)
-                        for obj in objects:
-                            if obj.object_name.endswith(".tif") and "raw" in obj.object_name:
-                                band_name = obj.object_name.split("/")[-1].split(".")[0]
-                                if band_name in bandas:
-                                    month_number = convertir_mes_a_numero(month_folder)
-                                    download_dir = os.path.join(local_download_path, str(year), band_name, month_number)
-                                    os.makedirs(download_dir, exist_ok=True)
-                                    local_file_path = os.path.join(download_dir, f"{zone}.tif")
-                                    download_tasks.append(executor.submit(descargar_archivo, client, obj, local_file_path))
-                    except S3Error as exc:
-                        print(f"Error al acceder a {composites_path}: {exc}")
-
-            for future in as_completed(download_tasks):
+    # Los mosaicos VRT referencian las descargas, así que la carpeta vive hasta
+    # el final de la petición (ámbito ``rasters_intermedios``).
+    local_download_path = carpeta_temporal()
+    download_tasks = {}
+    client = get_minio_client()
+    manifest = get_manifest()
+
+    def carpeta_de(grupo):
+        year, month_number, banda = grupo
+        return os.path.join(local_download_path, str(year), banda, month_number)
+
+    def ruta_de(grupo):
+        year, month_number, banda = grupo
+        return ruta_merge(carpeta_de(grupo), year, banda, month_number)
+
+    claves, servidos = {}, {}
+    with TransferJob() as job:
+        # Cada grupo se busca en la caché en cuanto su mes está listado; las
+        # bandas de meses ya fusionados por otra petición no se vuelven a descargar.
+        for grupo, objetos in manifest.iter_grupos(
+            client,
+            bucket_name,
+            utm_zones,
+            year_month_pairs,
+            "raw",
+            bandas,
+            lambda obj: (obj.year, convertir_mes_a_numero(obj.month), obj.name),
+        ):
+            claves[grupo], servidos[grupo] = buscar_producto(
+                bucket_name, grupo, objetos, aoi_bounds, ruta_de(grupo)
+            )
+            if servidos[grupo]:
+                continue
+            download_dir = carpeta_de(grupo)
+            os.makedirs(download_dir, exist_ok=True)
+            for obj in objetos:
+                local_file_path = os.path.join(download_dir, f"{obj.zone}.tif")
+                future = job.submit(descargar_archivo, client, obj, local_file_path, aoi_bounds)
+                download_tasks[future] = download_dir
+
+        # Como en ``parallel_download``: un objeto que falla tras agotar los
+        # reintentos deja su mes sin fusionar, pero no tumba la petición.
+        carpetas_incompletas = set()
+        for future in as_completed(download_tasks):
+            try:
                 future.result()
-
-        for year, month_folder in year_month_pairs:
-            month_number = convertir_mes_a_numero(month_folder)
-            for banda in bandas:
-                carpeta_mes = os.path.join(local_download_path, str(year), banda, month_number)
-                if os.path.exists(carpeta_mes):
-                    merge_path = merge_tifs(carpeta_mes, year, banda, month_number)
-                    if merge_path:
-                        rutas_mergeadas.append(merge_path)
+            except Exception as e:
+                print(f"Error descargando archivo: {e}")
+                carpetas_incompletas.add(download_tasks[future])
+
+    tareas_merge, rutas_grupo = [], {}
+    for year, month_folder in year_month_pairs:
+        month_number = convertir_mes_a_numero(month_folder)
+        for banda in bandas:
+            grupo = (year, month_number, banda)
+            carpeta_mes = carpeta_de(grupo)
+            if servidos.get(grupo):
+                rutas_grupo[grupo] = servidos[grupo]
+            elif carpeta_mes in carpetas_incompletas:
+                print(f"❌ Faltan objetos de {carpeta_mes}, no se fusiona un mes incompleto.")
+            elif os.path.exists(carpeta_mes):
+                tareas_merge.append((
+                    grupo,
+                    (carpeta_mes, year, banda, month_number, aoi_bounds),
+                    claves.get(grupo),
+                    ruta_de(grupo),
+                ))
+                rutas_grupo[grupo] = None
+
+    for grupo, merge_path in fusionar_grupos(merge_tifs, tareas_merge):
+        rutas_grupo[grupo] = merge_path
+        if merge_path and not merge_path.endswith(".vrt"):
+            # El mosaico GeoTIFF ya no depende de las teselas: se borran ya, y con
+            # ellas los enlaces que retienen entradas expulsadas de la caché.
+            shutil.rmtree(carpeta_de(grupo), ignore_errors=True)
+
+    for merge_path in rutas_grupo.values():
+        if merge_path:
+            rutas_mergeadas.append(merge_path)
 
     return rutas_mergeadas
 
@@ -150,13 +214,10 @@ def rgb(rutas_mergeadas):
             blue = handle_nodata(src2.read(1), src2.nodata)
 
             profile = src4.profile
-            profile.update(count=3, dtype=rasterio.uint16, nodata=None)
-            nombre_tif = os.path.join(salida_dir, f"RGB_{year}_{month_number}.tif")
+            profile.update(dtype=rasterio.uint16, nodata=None)
+            nombre_tif = intermediate_path(f"RGB_{year}_{month_number}.tif", salida_dir)
 
-            with rasterio.open(nombre_tif, 'w', **profile) as dst:
-                dst.write(red, 1)
-                dst.write(green, 2)
-                dst.write(blue, 3)
+            write_raster(nombre_tif, np.stack([red, green, blue]).astype(rasterio.uint16), profile)
 
             rutas_tif_rgb.append((nombre_tif, year, month_number))
 
@@ -264,12 +325,9 @@ def crear_tiff_rgb(rutas_mergeadas):
             blue = handle_nodata(src2.read(1), src2.nodata)
 
             profile = src4.profile
-            profile.update(count=3, dtype=rasterio.uint16, nodata=None)
+            profile.update(dtype=rasterio.uint16, nodata=None)
             nombre_tif = os.path.join(salida_dir, f"{year}_{month_number}.tif")
-            with rasterio.open(nombre_tif, 'w', **profile) as dst:
-                dst.write(red, 1)
-                dst.write(green, 2)
-                dst.write(blue, 3)
+            write_raster(nombre_tif, np.stack([red, green, blue]).astype(rasterio.uint16), profile)
             rutas_tif_rgb.append(nombre_tif)
 
     return salida_dir, rutas_tif_rgb
@@ -341,29 +399,16 @@ def merge_tifs_por_fecha_banda(tif_paths):
         grupos[clave].append(path)
 
     rutas_mergeadas = []
-    temp_dir = tempfile.mkdtemp()
-
-    for clave, archivos in grupos.items():
-        datasets = [rasterio.open(f) for f in archivos]
-        merged, output_transform = merge(datasets, method="last")
-
-        perfil = datasets[0].profile
-        perfil.update(
-            driver="GTiff",
-            height=merged.shape[1],
-            width=merged.shape[2],
-            transform=output_transform,
-            count=merged.shape[0],
-            dtype=merged.dtype,
-        )
-
-        output_path = os.path.join(temp_dir, f"{clave}.tif")
-        with rasterio.open(output_path, "w", **perfil) as dst:
-            dst.write(merged)
-
-        for ds in datasets:
-            ds.close()
-
-        rutas_mergeadas.append(output_path)
+    # Los recortes en memoria se fusionan en memoria, en este proceso.
+    local = intermedios_en_memoria()
+    temp_dir = None if local else tempfile.mkdtemp()
+
+    tareas = [
+        (clave, (archivos, intermediate_path(f"{clave}.tif", temp_dir)))
+        for clave, archivos in grupos.items()
+    ]
+    for clave, ruta in map_grupos(merge_grupo, tareas, local=local):
+        if ruta:
+            rutas_mergeadas.append(ruta)
 
     return rutas_mergeadas
@@ -1,5 +1,6 @@
 import os
 import tempfile
+import threading
 from typing import List
 
 import folium
@@ -15,7 +16,9 @@ from shapely.ops import unary_union
 from matplotlib.colors import LinearSegmentedColormap
 from branca.colormap import LinearColormap
 from collections import defaultdict
-from rasterio.merge import merge
+from app.merge_pool import map_grupos
+from app.mosaic import merge_por_bloques, write_vrt_mosaic
+from app.raster_io import intermediate_path, intermedios_en_memoria
 from PIL import Image, ImageDraw, ImageFont
 
 
@@ -31,6 +34,8 @@ colors = [
 ]
 custom_cmap = LinearSegmentedColormap.from_list("NDWI_cmap", colors, N=256)
 
+_PYPLOT_LOCK = threading.Lock()
+
 
 def generate_map_from_geojson(geojson_data: dict, image_paths: List[str], gif_path, indexes) -> str:
     vmin = -0.6
@@ -52,11 +57,12 @@ def generate_map_from_geojson(geojson_data: dict, image_paths: List[str], gif_pa
             array = src.read(1)
             norm = Normalize(vmin=vmin, vmax=vmax)
 
-            plt.imshow(array, norm=norm, cmap=custom_cmap)
-            plt.axis("off")
             temp_png_path = os.path.join(tempfile.gettempdir(), f"temp_{png_name}")
-            plt.savefig(temp_png_path, bbox_inches="tight", pad_inches=0, dpi=800)
-            plt.close()
+            with _PYPLOT_LOCK:
+                plt.imshow(array, norm=norm, cmap=custom_cmap)
+                plt.axis("off")
+                plt.savefig(temp_png_path, bbox_inches="tight", pad_inches=0, dpi=800)
+                plt.close()
 
 
             tiff_crs = CRS(src.crs)
@@ -124,6 +130,23 @@ def generate_map_from_geojson(geojson_data: dict, image_paths: List[str], gif_pa
     folium.LayerControl().add_to(m)
     return m
 
+def merge_grupo(archivos, output_path):
+    """
+    Fusiona las imágenes de un grupo (la última queda encima) en ``output_path``,
+    o en un VRT junto a él con ``MOSAIC_MODE=vrt``. Devuelve la ruta escrita.
+    """
+    vrt_path = write_vrt_mosaic(archivos, output_path)
+    if vrt_path:
+        return vrt_path
+
+    datasets = [rasterio.open(f) for f in archivos]
+    merge_por_bloques(datasets, output_path, method="last")
+
+    for ds in datasets:
+        ds.close()
+
+    return output_path
+
 def merge_tifs_por_fecha(tif_paths):
     """
     Recibe una lista de imágenes TIFF, las agrupa por índice y fecha (año y mes en el nombre),
@@ -149,30 +172,17 @@ def merge_tifs_por_fecha(tif_paths):
         grupos[clave].append(path)
 
     rutas_mergeadas = []
-    temp_dir = tempfile.mkdtemp()
-
-    for clave, archivos in grupos.items():
-        datasets = [rasterio.open(f) for f in archivos]
-        merged, output_transform = merge(datasets, method="last")
-
-        perfil = datasets[0].profile
-        perfil.update(
-            driver="GTiff",
-            height=merged.shape[1],
-            width=merged.shape[2],
-            transform=output_transform,
-            count=datasets[0].count,
-            dtype=merged.dtype,
-        )
-
-        output_path = os.path.join(temp_dir, f"{clave}.tif")
-        with rasterio.open(output_path, "w", **perfil) as dst:
-            dst.write(merged)
-
-        for ds in datasets:
-            ds.close()
-
-        rutas_mergeadas.append(output_path)
+    # Los recortes en memoria se fusionan en memoria, en este proceso.
+    local = intermedios_en_memoria()
+    temp_dir = None if local else tempfile.mkdtemp()
+
+    tareas = [
+        (clave, (archivos, intermediate_path(f"{clave}.tif", temp_dir)))
+        for clave, archivos in grupos.items()
+    ]
+    for clave, ruta in map_grupos(merge_grupo, tareas, local=local):
+        if ruta:
+            rutas_mergeadas.append(ruta)
 
     return rutas_mergeadas
 
@@ -201,86 +211,51 @@ def merge_tifs_por_fecha(tif_paths):
         grupos[clave].append(path)
 
     rutas_mergeadas = []
-    temp_dir = tempfile.mkdtemp()
-
-    for clave, archivos in grupos.items():
-        datasets = [rasterio.open(f) for f in archivos]
-        merged, output_transform = merge(datasets, method="last")
-
-        perfil = datasets[0].profile
-        perfil.update(
-            driver="GTiff",
-            height=merged.shape[1],
-            width=merged.shape[2],
-            transform=output_transform,
-            count=datasets[0].count,
-            dtype=merged.dtype,
-        )
-
-        output_path = os.path.join(temp_dir, f"{clave}.tif")
-        with rasterio.open(output_path, "w", **perfil) as dst:
-            dst.write(merged)
-
-        for ds in datasets:
-            ds.close()
-
-        rutas_mergeadas.append(output_path)
+    # Los recortes en memoria se fusionan en memoria, en este proceso.
+    local = intermedios_en_memoria()
+    temp_dir = None if local else tempfile.mkdtemp()
+
+    tareas = [
+        (clave, (archivos, intermediate_path(f"{clave}.tif", temp_dir)))
+        for clave, archivos in grupos.items()
+    ]
+    for clave, ruta in map_grupos(merge_grupo, tareas, local=local):
+        if ruta:
+            rutas_mergeadas.append(ruta)
 
     return rutas_mergeadas
 
-def crear_gif_no_rgb(image_paths: List[str]) -> str:
-    png_list=[]
+def render_frame_no_rgb(tiff_file: str) -> Image.Image:
+    """
+    Pinta un TIFF de índice con la paleta de estrés hídrico y le añade como
+    rótulo el nombre del fichero. Devuelve el fotograma listo para el GIF.
+    """
     vmin = -0.6
     vmax = 0.25
-    date_groups = {}
-
-    geojson_crs = CRS.from_epsg(4326)
-
-    for tiff_file in image_paths:
-        base_name = os.path.basename(tiff_file)
-        parts = base_name.split("_")
-        date = f"{parts[1]}_{parts[2]}"
-        
-        png_name = os.path.splitext(base_name)[0] + ".png"
-        output_png_path = os.path.join(tempfile.gettempdir(), png_name)
-
-        with rasterio.open(tiff_file) as src:
-            array = src.read(1)
-            norm = Normalize(vmin=vmin, vmax=vmax)
 
-            plt.imshow(array, norm=norm, cmap=custom_cmap)
-            plt.axis("off")
-            temp_png_path = os.path.join(tempfile.gettempdir(), f"temp_{png_name}")
-            plt.savefig(temp_png_path, bbox_inches="tight", pad_inches=0, dpi=800)
-            plt.close()
-
-
-            tiff_crs = CRS(src.crs)
-            bounds = src.bounds 
-            
-
-            if tiff_crs != geojson_crs:
-                bounds = transform_bounds(tiff_crs, geojson_crs, *bounds)
-
-
-            offset_x = (bounds[2] - bounds[0]) 
-            offset_y = (bounds[3] - bounds[1]) 
-            
-            image_bounds = [[bounds[3] - offset_y, bounds[0] + offset_x], 
-                            [bounds[1] + offset_y, bounds[2] - offset_x]] 
-
-        with Image.open(temp_png_path) as img:
-            img = img.convert("RGBA")
-            data = np.array(img)
-            white_pixels = (data[:, :, 0] == 255) & (data[:, :, 1] == 255) & (data[:, :, 2] == 255)
-            data[white_pixels, 3] = 0
-            processed_img = Image.fromarray(data, "RGBA")
-            processed_img.save(output_png_path)
-            png_list.append(output_png_path)
-
-        if date not in date_groups:
-            date_groups[date] = []
-        date_groups[date].append((output_png_path, image_bounds))  
+    base_name = os.path.basename(tiff_file)
+    png_name = os.path.splitext(base_name)[0] + ".png"
+    output_png_path = os.path.join(tempfile.gettempdir(), png_name)
+
+    with rasterio.open(tiff_file) as src:
+        array = src.read(1)
+    norm = Normalize(vmin=vmin, vmax=vmax)
+
+    temp_png_path = os.path.join(tempfile.gettempdir(), f"temp_{png_name}")
+    # pyplot mantiene estado global: sólo un hilo puede pintar a la vez.
+    with _PYPLOT_LOCK:
+        plt.imshow(array, norm=norm, cmap=custom_cmap)
+        plt.axis("off")
+        plt.savefig(temp_png_path, bbox_inches="tight", pad_inches=0, dpi=800)
+        plt.close()
+
+    with Image.open(temp_png_path) as img:
+        img = img.convert("RGBA")
+        data = np.array(img)
+        white_pixels = (data[:, :, 0] == 255) & (data[:, :, 1] == 255) & (data[:, :, 2] == 255)
+        data[white_pixels, 3] = 0
+        processed_img = Image.fromarray(data, "RGBA")
+        processed_img.save(output_png_path)
 
     font_size = 50  
 
@@ -292,33 +267,37 @@ def crear_gif_no_rgb(image_paths: List[str]) -> str:
         print("Error cargando la fuente:", e)
         font = ImageFont.load_default()
 
-    frames = []
-    for img_path in png_list:
-        img = Image.open(img_path).convert("RGBA")
-        draw = ImageDraw.Draw(img)
+    img = Image.open(output_png_path).convert("RGBA")
+    draw = ImageDraw.Draw(img)
 
-        texto = img_path.split("/")[-1].replace(".png", "")
+    texto = output_png_path.split("/")[-1].replace(".png", "")
 
-        text_bbox = draw.textbbox((0, 0), texto, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
+    text_bbox = draw.textbbox((0, 0), texto, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
 
-        text_x = 20
-        text_y = 20
-        text_position = (text_x, text_y)
+    text_x = 20
+    text_y = 20
+    text_position = (text_x, text_y)
 
-        bg_padding = 30
-        bg_position = [
-            text_x - bg_padding, text_y - bg_padding,
-            text_x + text_width + bg_padding, text_y + text_height + bg_padding
-        ]
-        draw.rectangle(bg_position, fill=(0, 0, 0, 255))
+    bg_padding = 30
+    bg_position = [
+        text_x - bg_padding, text_y - bg_padding,
+        text_x + text_width + bg_padding, text_y + text_height + bg_padding
+    ]
+    draw.rectangle(bg_position, fill=(0, 0, 0, 255))
 
-        draw.text(text_position, texto, font=font, fill="white")
-        
-        frames.append(img)
+    draw.text(text_position, texto, font=font, fill="white")
 
+    return img
+
+
+def guardar_gif(frames: List[Image.Image]) -> str:
     output_gif = os.path.join(tempfile.gettempdir(), "animation.gif")
     frames[0].save(output_gif, save_all=True, append_images=frames[1:], duration=1000, loop=0)
+    return output_gif
 
-    return output_gif
\ No newline at end of file
+
+def crear_gif_no_rgb(image_paths: List[str]) -> str:
+    frames = [render_frame_no_rgb(tiff_file) for tiff_file in image_paths]
+    return guardar_gif(frames)
@@ -1,3 +1,4 @@
+import functools
 import glob
 import json
 import os
@@ -19,7 +20,7 @@ from gradio_calendar import Calendar
 from shapely.geometry import shape
 from sigpac_tools.find import find_from_cadastral_registry
 
-from app.cut_from_geometry import cut_from_geometry
+from app.cut_from_geometry import cut_from_geometries, cut_from_geometry, geometries_to_gdf
 from app.download_merge import download_tif_files
 from app.download_merge_rgb import workflow_generar_gif, descargar_archivos_tif,rgb,crear_gif,merge_tifs_por_fecha_banda
 from app.generate_map import generate_map_from_geojson
@@ -27,9 +28,15 @@ from app.generate_map import crear_gif_no_rgb
 from app.generate_map import merge_tifs_por_fecha
 
 from app.get_tiles import get_tiles_polygons
+from app.manifest import registrar_sin_listar
+from app.pipeline import pipeline_enabled, run_sentinel_pipeline
 from app.plots import all_statistics, plot_statistics, temporal_means
+from app.raster_io import rasters_intermedios
 from app.sigpac_to_geometry import sigpac_to_geometry
-from app.statistics_shapefile import calculate_statistics_in_polygon
+from app.statistics_shapefile import (
+    calculate_statistics_by_index,
+    calculate_statistics_in_polygon,
+)
 
 lat = 37.5443
 lon = -4.7278
@@ -40,6 +47,27 @@ initial_map = folium.Map(
 )
 
 
+def avisar_meses_sin_listar(fn):
+    """
+    Ejecuta ``fn`` omitiendo los meses que no se han podido listar en el bucket,
+    en vez de abortar la petición, y avisa al terminar de cuáles faltan.
+    """
+    @functools.wraps(fn)
+    def envoltura(*args, **kwargs):
+        with registrar_sin_listar() as sin_listar:
+            resultado = fn(*args, **kwargs)
+        if sin_listar:
+            meses = ", ".join(
+                f"{zone} {month} {year}" for zone, year, month in dict.fromkeys(sin_listar)
+            )
+            gr.Warning(f"No se han podido consultar y se han omitido: {meses}")
+            gr.Warning(f"Could not be listed and were skipped: {meses}")
+        return resultado
+
+    return envoltura
+
+
+@rasters_intermedios()
 def process_catastral_data(    catastral_registry: int, images: List[str]) -> Tuple[str, str]:
     """
     Processes images by cutting them according to SIGPAC geometry and returns a ZIP file with cropped images and geometry in GeoJSON format.
@@ -189,6 +217,8 @@ def process_catastral_data(    catastral_registry: int, images: List[str]) -> Tu
         raise Exception(f"An error occurred: {str(e)}")
 
 
+@rasters_intermedios()
+@avisar_meses_sin_listar
 def process_catastral_data_sentinel(
     catastral_registry: int, indexes: list, date_start: str, date_end: str) -> str:
     """
@@ -235,10 +265,26 @@ def process_catastral_data_sentinel(
 
     zones_utm = get_tiles_polygons(gdf)
     list_zones_utm = list(zones_utm)
+    aoi_bounds = tuple(gdf.to_crs("EPSG:4326").total_bounds)
+    if pipeline_enabled():
+        cut_features = [
+            (feature["geometry"], catastral_registry)
+            for feature in geojson_data["features"]
+        ]
+        cropped_images, output_gif = run_sentinel_pipeline(
+            list_zones_utm, years, months, indexes, cut_features, aoi_bounds, merge_crops=False
+        )
+        if not cropped_images:
+            gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
+            gr.Warning("No images are available for the selected date, images are processed at the end of each month.")
+            return None, None
+        main_map = generate_map_from_geojson(geojson_data, cropped_images, output_gif, indexes)
+        return output_gif,main_map._repr_html_()
+
     if(indexes==["RGB"]):
-        images_dir = descargar_archivos_tif(list_zones_utm, years, months)
+        images_dir = descargar_archivos_tif(list_zones_utm, years, months, aoi_bounds)
     else:
-        images_dir = download_tif_files(list_zones_utm, years, indexes, months)
+        images_dir = download_tif_files(list_zones_utm, years, indexes, months, aoi_bounds)
 
     if not images_dir:
         gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
@@ -272,6 +318,7 @@ def process_catastral_data_sentinel(
     return output_gif,main_map._repr_html_()
 
 
+@rasters_intermedios()
 def process_geojson_data(geojson: str, images: List[str]) -> str:
     """
     Processes images by cutting them according to the provided GeoJSON geometry and returns a ZIP file with cropped images.
@@ -407,6 +454,8 @@ def process_geojson_data(geojson: str, images: List[str]) -> str:
         raise Exception(f"An error occurred: {str(e)}")
 
 
+@rasters_intermedios()
+@avisar_meses_sin_listar
 def process_geojson_data_sentinel(
     geojson: dict, indexes: list, date_start: str, date_end: str) -> str:
     """
@@ -448,10 +497,29 @@ def process_geojson_data_sentinel(
 
     zones_utm = get_tiles_polygons(gdf)
     list_zones_utm = list(zones_utm)
+    aoi_bounds = tuple(gdf.to_crs("EPSG:4326").total_bounds)
+    if pipeline_enabled():
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")[:-3]
+        for i, feature in enumerate(geojson_data["features"]):
+            feature["objectID"] = f"{timestamp}_{i}"
+        cut_features = [
+            (feature["geometry"], feature["objectID"])
+            for feature in geojson_data["features"]
+        ]
+        cropped_images_merge, output_gif = run_sentinel_pipeline(
+            list_zones_utm, years, months, indexes, cut_features, aoi_bounds, merge_crops=True
+        )
+        if not cropped_images_merge:
+            gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
+            gr.Warning("No images are available for the selected date, images are processed at the end of each month.")
+            return None, None
+        main_map = generate_map_from_geojson(geojson_data, cropped_images_merge, output_gif, indexes)
+        return output_gif,main_map._repr_html_()
+
     if(indexes==["RGB"]):
-        images_dir = descargar_archivos_tif(list_zones_utm, years, months)
+        images_dir = descargar_archivos_tif(list_zones_utm, years, months, aoi_bounds)
     else:
-        images_dir = download_tif_files(list_zones_utm, years, indexes, months)
+        images_dir = download_tif_files(list_zones_utm, years, indexes, months, aoi_bounds)
 
     if not images_dir:
         gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
@@ -469,13 +537,19 @@ def process_geojson_data_sentinel(
         raise ValueError(
             f"Unsupported format. You must upload images in one unique format."
         )
-    cropped_images = []
-    for feature in geojson_data["features"]:
-        geometry = feature["geometry"]
-        polygon_id = datetime.now().strftime("%Y%m%d%H%M%S%f")[:-3]
-        feature["objectID"] = polygon_id
-        geometry_id = feature["objectID"]
-        cropped_images.extend(cut_from_geometry(geometry, unique_formats[0], images_dir, geometry_id))
+    # Un instante común más la posición: en un bucle el reloj repite milisegundo.
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")[:-3]
+    geometry_ids = []
+    for i, feature in enumerate(geojson_data["features"]):
+        feature["objectID"] = f"{timestamp}_{i}"
+        geometry_ids.append(feature["objectID"])
+    recortes = cut_from_geometries(
+        geometries_to_gdf([feature["geometry"] for feature in geojson_data["features"]]),
+        unique_formats[0],
+        images_dir,
+        geometry_ids,
+    )
+    cropped_images = [recorte for recortes_feature in recortes for recorte in recortes_feature]
     
     if(indexes==["RGB"]):
         cropped_images_merge=merge_tifs_por_fecha_banda(cropped_images)
@@ -515,6 +589,7 @@ def add_stats_to_dbf(    dbf_path: str, stats: list, indice: str, output_dir: st
     return updated_dbf_path, csv_path
 
 
+@rasters_intermedios()
 def process_shp_data(shp: str, images: List[str]) -> str:
     """
     Processes images by cutting them according to the provided shapefile geometry and returns a ZIP file with cropped images.
@@ -572,18 +647,19 @@ def process_shp_data(shp: str, images: List[str]) -> str:
             with open(json_path) as f:
                 geojson_data = json.load(f)
 
+            # Cada imagen se abre una sola vez para todas las parcelas.
+            recortes = cut_from_geometries(
+                gdf, unique_formats[0], images, gdf[first_column_name]
+            )
+            # Todas las parcelas e índices a la vez, repartidos en el pool de
+            # estadísticas.
+            stats_por_indice = calculate_statistics_by_index(
+                gdf, images, list(gdf[first_column_name]), indices
+            )
             for indice in indices:
-                stats = []
-                for feature in geojson_data["features"]:
-                    geometry = feature["geometry"]
-                    polygon_id = feature["properties"][first_column_name]
-                    images_dir = cut_from_geometry(geometry, unique_formats[0], images, polygon_id)
+                for images_dir in recortes:
                     cropped_images.extend(images_dir)
-                    stats.append(
-                        calculate_statistics_in_polygon(
-                            geometry, images_dir, polygon_id, indice
-                        )
-                    )
+                stats = stats_por_indice[indice]
                 indice_dir = os.path.join(extract_path, indice)
                 os.makedirs(indice_dir, exist_ok=True)
                 updated_dbf_path, csv_path = add_stats_to_dbf(
@@ -678,6 +754,8 @@ def process_shp_data(shp: str, images: List[str]) -> str:
         raise Exception(f"An error occurred: {str(e)}")
 
 
+@rasters_intermedios()
+@avisar_meses_sin_listar
 def process_shp_data_sentinel(    shp: str, indexes: list, date_start: str, date_end: str) -> str:
     """
     Processes images by cutting them according to the provided shapefile geometry and returns a ZIP file with cropped images.
@@ -727,10 +805,26 @@ def process_shp_data_sentinel(    shp: str, indexes: list, date_start: str, date
         geojson_data = json.load(f)
     zones_utm = get_tiles_polygons(gdf)
     list_zones_utm = list(zones_utm)
+    aoi_bounds = tuple(gdf.to_crs("EPSG:4326").total_bounds)
+    if pipeline_enabled():
+        cut_features = [
+            (feature["geometry"], feature["properties"][first_column_name])
+            for feature in geojson_data["features"]
+        ]
+        cropped_images_merge, output_gif = run_sentinel_pipeline(
+            list_zones_utm, years, months, indexes, cut_features, aoi_bounds, merge_crops=True
+        )
+        if not cropped_images_merge:
+            gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
+            gr.Warning("No images are available for the selected date, images are processed at the end of each month.")
+            return None, None
+        main_map = generate_map_from_geojson(geojson_data, cropped_images_merge, output_gif, indexes)
+        return output_gif,main_map._repr_html_()
+
     if(indexes==["RGB"]):
-        images_dir = descargar_archivos_tif(list_zones_utm, years, months)
+        images_dir = descargar_archivos_tif(list_zones_utm, years, months, aoi_bounds)
     else:
-        images_dir = download_tif_files(list_zones_utm, years, indexes, months)
+        images_dir = download_tif_files(list_zones_utm, years, indexes, months, aoi_bounds)
 
     if not images_dir:
         gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
@@ -748,11 +842,10 @@ def process_shp_data_sentinel(    shp: str, indexes: list, date_start: str, date
         raise ValueError(
             f"Unsupported format. You must upload images in one unique format."
         )
-    cropped_images = []
-    for feature in geojson_data["features"]:
-        geometry = feature["geometry"]
-        geometry_id = feature["properties"][first_column_name]
-        cropped_images.extend(cut_from_geometry(geometry, unique_formats[0], images_dir, geometry_id))
+    recortes = cut_from_geometries(
+        gdf, unique_formats[0], images_dir, gdf[first_column_name]
+    )
+    cropped_images = [recorte for recortes_feature in recortes for recorte in recortes_feature]
     
     if(indexes==["RGB"]):
         cropped_images_merge=merge_tifs_por_fecha_banda(cropped_images)
@@ -766,6 +859,7 @@ def process_shp_data_sentinel(    shp: str, indexes: list, date_start: str, date
     return output_gif,main_map._repr_html_()
 
 
+@rasters_intermedios()
 def process_csv_data(csv: str, images: List[str], latitude_column: str, longitude_column: str) -> str:
     """
     Processes images by cutting them according to the provided shapefile geometry and returns a ZIP file with cropped images.
@@ -922,6 +1016,8 @@ def process_csv_data(csv: str, images: List[str], latitude_column: str, longitud
     return zip_output_plots, zip_output_geojson, main_map._repr_html_()
 
 
+@rasters_intermedios()
+@avisar_meses_sin_listar
 def process_csv_data_sentinel(
     csv: str,
     indexes: list,
@@ -996,10 +1092,30 @@ def process_csv_data_sentinel(
 
     zones_utm = get_tiles_polygons(gdf)
     list_zones_utm = list(zones_utm)
+    aoi_bounds = tuple(gdf.to_crs("EPSG:4326").total_bounds)
+    # Un único instante más la posición: el reloj repite el milisegundo en el bucle.
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")[:-3]
+    for i, feature in enumerate(geojson_data["features"]):
+        feature["objectID"] = f"{timestamp}_{i}"
+    if pipeline_enabled():
+        cut_features = [
+            (feature["geometry"], feature["objectID"])
+            for feature in geojson_data["features"]
+        ]
+        cropped_images, output_gif = run_sentinel_pipeline(
+            list_zones_utm, years, months, indexes, cut_features, aoi_bounds, merge_crops=False
+        )
+        if not cropped_images:
+            gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
+            gr.Warning("No images are available for the selected date, images are processed at the end of each month.")
+            return None, None
+        main_map = generate_map_from_geojson(geojson_data, cropped_images, output_gif, indexes)
+        return output_gif,main_map._repr_html_()
+
     if(indexes==["RGB"]):
-        images_dir = descargar_archivos_tif(list_zones_utm, years, months)
+        images_dir = descargar_archivos_tif(list_zones_utm, years, months, aoi_bounds)
     else:
-        images_dir = download_tif_files(list_zones_utm, years, indexes, months)
+        images_dir = download_tif_files(list_zones_utm, years, indexes, months, aoi_bounds)
 
     if not images_dir:
         gr.Warning("No hay imagenes disponibles para la fecha seleccionada, las imágenes son procesadas a final de cada mes.")
@@ -1020,7 +1136,7 @@ def process_csv_data_sentinel(
     cropped_images = []
     for feature in geojson_data["features"]:
         geometry = feature["geometry"]
-        geometry_id = datetime.now().strftime("%Y%m%d%H%M%S%f")[:-3]
+        geometry_id = feature["objectID"]
         cropped_images.extend(cut_from_geometry(geometry, unique_formats[0], images_dir, geometry_id))
     
     if(indexes==["RGB"]):
@@ -0,0 +1,149 @@
+import os
+import shutil
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from minio.error import S3Error
+
+
+LocalObject = namedtuple(
+    "LocalObject", ["bucket_name", "object_name", "size", "etag", "last_modified", "is_dir"]
+)
+
+
+def _etag(info):
+    # ETag barato a partir de tamaño y fecha de modificación. Lleva un guion,
+    # como los de las subidas multiparte, para que no se compare contra un MD5.
+    return f'"{info.st_size:x}-{info.st_mtime_ns:x}"'
+
+
+class LocalResponse:
+    """
+    Respuesta de ``get_object`` sobre un fichero local, con la misma interfaz
+    que la respuesta HTTP de MinIO (``stream``, ``read``, ``close``, ``release_conn``).
+    """
+
+    def __init__(self, path, offset=0, length=0):
+        self._file = open(path, "rb")
+        self._file.seek(offset)
+        self._remaining = length or None
+
+    def read(self, amt=None):
+        if self._remaining is not None:
+            amt = self._remaining if amt is None else min(amt, self._remaining)
+        data = self._file.read(-1 if amt is None else amt)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+    def stream(self, amt=1024 * 1024):
+        while True:
+            data = self.read(amt)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self._file.close()
+
+    def release_conn(self):
+        pass
+
+
+class LocalObjectStore:
+    """
+    Sustituto de ``Minio`` respaldado por un directorio: cada bucket es una
+    subcarpeta de ``root`` y cada objeto un fichero con la misma ruta que su
+    nombre. Implementa las llamadas que usa la aplicación para poder ejecutar el
+    flujo completo sin red.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket_name, object_name=""):
+        return os.path.join(self.root, bucket_name, *object_name.split("/"))
+
+    def _error(self, code, bucket_name, object_name=None):
+        return S3Error(
+            code,
+            f"{code}: {bucket_name}/{object_name or ''}",
+            object_name,
+            None,
+            None,
+            None,
+            bucket_name=bucket_name,
+            object_name=object_name,
+        )
+
+    def bucket_exists(self, bucket_name):
+        return os.path.isdir(self._path(bucket_name))
+
+    def make_bucket(self, bucket_name):
+        os.makedirs(self._path(bucket_name), exist_ok=True)
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False):
+        if not self.bucket_exists(bucket_name):
+            raise self._error("NoSuchBucket", bucket_name)
+        prefix = prefix or ""
+        carpeta, _, inicio = prefix.rpartition("/")
+        base = self._path(bucket_name, carpeta)
+        if not os.path.isdir(base):
+            return
+        for nombre in sorted(os.listdir(base)):
+            if not nombre.startswith(inicio):
+                continue
+            object_name = f"{carpeta}/{nombre}" if carpeta else nombre
+            ruta = os.path.join(base, nombre)
+            if os.path.isdir(ruta):
+                if recursive:
+                    yield from self.list_objects(bucket_name, f"{object_name}/", True)
+                else:
+                    yield LocalObject(bucket_name, f"{object_name}/", None, None, None, True)
+            elif not nombre.endswith(".part"):
+                yield self._stat(bucket_name, object_name, ruta)
+
+    def _stat(self, bucket_name, object_name, ruta):
+        info = os.stat(ruta)
+        return LocalObject(
+            bucket_name,
+            object_name,
+            info.st_size,
+            _etag(info),
+            datetime.fromtimestamp(info.st_mtime, tz=timezone.utc),
+            False,
+        )
+
+    def stat_object(self, bucket_name, object_name):
+        ruta = self._path(bucket_name, object_name)
+        if not os.path.isfile(ruta):
+            raise self._error("NoSuchKey", bucket_name, object_name)
+        return self._stat(bucket_name, object_name, ruta)
+
+    def get_object(self, bucket_name, object_name, offset=0, length=0):
+        ruta = self._path(bucket_name, object_name)
+        if not os.path.isfile(ruta):
+            raise self._error("NoSuchKey", bucket_name, object_name)
+        return LocalResponse(ruta, offset, length)
+
+    def fget_object(self, bucket_name, object_name, file_path):
+        ruta = self._path(bucket_name, object_name)
+        if not os.path.isfile(ruta):
+            raise self._error("NoSuchKey", bucket_name, object_name)
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        shutil.copyfile(ruta, file_path)
+        return self.stat_object(bucket_name, object_name)
+
+    def fput_object(self, bucket_name, object_name, file_path):
+        ruta = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp_path = f"{ruta}.part"
+        shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, ruta)
+        return self.stat_object(bucket_name, object_name)
+
+    def local_path(self, bucket_name, object_name):
+        """
+        Ruta en disco del objeto, para abrirlo directamente con rasterio.
+        """
+        return self._path(bucket_name, object_name)
@@ -12,6 +12,7 @@ from sqlmodel import Field, Session, SQLModel, create_engine, select
 
 from app.database import User, create_db_and_tables, engine
 from app.interface import io
+from app.prefetch import detener_prefetch, iniciar_prefetch
 from app.schema import schema
 
 load_dotenv()
@@ -55,6 +56,12 @@ def authenticate_user(username: str, password: str) -> bool:
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    iniciar_prefetch()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    detener_prefetch()
 
 
 @app.get("/json", response_model=dict)
@@ -0,0 +1,518 @@
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", "db/manifest.db")
+# Segundos tras los que se vuelve a listar un mes reciente (o vacío) del bucket.
+MANIFEST_REFRESH_TTL = int(os.getenv("MANIFEST_REFRESH_TTL", "21600"))
+# Número máximo de listados simultáneos contra el bucket.
+LISTING_MAX_WORKERS = int(os.getenv("LISTING_MAX_WORKERS", "8"))
+
+MESES_INGLES = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+ManifestObject = namedtuple(
+    "ManifestObject",
+    [
+        "object_name",
+        "size",
+        "etag",
+        "zone",
+        "year",
+        "month",
+        "kind",
+        "name",
+        "last_modified",
+    ],
+)
+
+# Marca que emite el listado cuando un prefijo (zona, año, mes) se ha listado entero.
+PrefijoListado = namedtuple("PrefijoListado", ["zone", "year", "month"])
+
+
+class ListadoError(Exception):
+    """Algún prefijo no se ha podido listar; sus objetos no se han entregado."""
+
+    def __init__(self, prefijos):
+        self.prefijos = list(prefijos)
+        nombres = ", ".join(composites_prefix(*prefijo) for prefijo in self.prefijos)
+        super().__init__(f"No se han podido listar: {nombres}")
+
+
+# Prefijos sin listar del ámbito ``registrar_sin_listar`` actual (p. ej. una petición).
+_sin_listar = contextvars.ContextVar("prefijos_sin_listar", default=None)
+
+
+@contextmanager
+def registrar_sin_listar():
+    """
+    Ámbito en el que ``iter_grupos`` omite los meses con algún prefijo sin
+    listar, en vez de lanzar ``ListadoError``, y los anota en la lista que
+    devuelve como ``PrefijoListado``.
+    """
+    sin_listar = []
+    token = _sin_listar.set(sin_listar)
+    try:
+        yield sin_listar
+    finally:
+        _sin_listar.reset(token)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    object_name TEXT NOT NULL,
+    zone TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    PRIMARY KEY (bucket, object_name)
+);
+CREATE INDEX IF NOT EXISTS objects_lookup
+    ON objects (bucket, kind, zone, period);
+CREATE TABLE IF NOT EXISTS prefixes (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    object_count INTEGER NOT NULL,
+    refreshed_at REAL NOT NULL,
+    latency_ms REAL,
+    PRIMARY KEY (bucket, prefix)
+);
+"""
+
+
+def periodo(year, month):
+    """
+    Convierte un año y un nombre de mes en inglés en un entero AAAAMM ordenable.
+    """
+    return int(year) * 100 + MESES_INGLES.index(month) + 1
+
+
+def composites_prefix(zone, year, month):
+    return f"{zone}/{year}/{month}/composites/"
+
+
+def parse_object_name(object_name):
+    """
+    Descompone ``zone/year/Month/composites/{indexes,raw}/.../name.tif``.
+    Devuelve None si el objeto no sigue ese esquema.
+    """
+    partes = object_name.split("/")
+    if len(partes) < 6 or partes[3] != "composites" or partes[2] not in MESES_INGLES:
+        return None
+    if not partes[1].isdigit():
+        return None
+    nombre = os.path.splitext(partes[-1])[0]
+    return partes[0], int(partes[1]), partes[2], partes[4], nombre
+
+
+def manifest_object(obj):
+    """
+    Convierte un objeto devuelto por ``list_objects`` en un ``ManifestObject``,
+    o devuelve None si no es un GeoTIFF con el esquema de composites.
+    """
+    partes = parse_object_name(obj.object_name)
+    if partes is None or not obj.object_name.endswith(".tif"):
+        return None
+    zone, year, month, kind, nombre = partes
+    return ManifestObject(
+        obj.object_name,
+        obj.size,
+        (obj.etag or "").strip('"'),
+        zone,
+        year,
+        month,
+        kind,
+        nombre,
+        str(obj.last_modified),
+    )
+
+
+class BucketManifest:
+    """
+    Índice local (SQLite) de la estructura del bucket de composites.
+
+    Cada prefijo ``zone/year/Month/composites/`` se lista una sola vez y sus objetos
+    (con tamaño y ETag) quedan guardados. Los meses pasados se consideran
+    inmutables; sólo los meses recientes y los prefijos vacíos se vuelven a listar
+    cuando han pasado ``MANIFEST_REFRESH_TTL`` segundos.
+    """
+
+    def __init__(self, path, refresh_ttl=MANIFEST_REFRESH_TTL):
+        self.path = path
+        self.refresh_ttl = refresh_ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(prefixes)")}
+            if "latency_ms" not in columnas:
+                conn.execute("ALTER TABLE prefixes ADD COLUMN latency_ms REAL")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _is_recent(self, period):
+        hoy = datetime.now()
+        actual = hoy.year * 12 + hoy.month - 1
+        return actual - ((period // 100) * 12 + period % 100 - 1) <= 1
+
+    def stale_prefixes(self, bucket_name, zones, year_months):
+        """
+        Devuelve los prefijos (zone, year, month) que hay que (re)listar.
+        """
+        ahora = time.time()
+        with self._connect() as conn:
+            conocidos = {
+                prefix: (count, refreshed_at)
+                for prefix, count, refreshed_at in conn.execute(
+                    "SELECT prefix, object_count, refreshed_at FROM prefixes WHERE bucket = ?",
+                    (bucket_name,),
+                )
+            }
+        pendientes = []
+        for zone in zones:
+            for year, month in year_months:
+                prefix = composites_prefix(zone, year, month)
+                if prefix not in conocidos:
+                    pendientes.append((zone, year, month))
+                    continue
+                count, refreshed_at = conocidos[prefix]
+                caducado = ahora - refreshed_at > self.refresh_ttl
+                if caducado and (count == 0 or self._is_recent(periodo(year, month))):
+                    pendientes.append((zone, year, month))
+        return pendientes
+
+    def store_listing(self, bucket_name, zone, year, month, objects, latency_ms=None):
+        """
+        Sustituye en el manifiesto el contenido del prefijo por ``objects``
+        (lista de ``ManifestObject``) y registra la latencia del listado.
+        """
+        prefix = composites_prefix(zone, year, month)
+        period = periodo(year, month)
+        filas = [
+            (
+                bucket_name,
+                obj.object_name,
+                zone,
+                int(year),
+                month,
+                period,
+                obj.kind,
+                obj.name,
+                obj.size,
+                obj.etag,
+                obj.last_modified,
+            )
+            for obj in objects
+        ]
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM objects WHERE bucket = ? AND zone = ? AND period = ?",
+                (bucket_name, zone, period),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                filas,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO prefixes "
+                "(bucket, prefix, period, object_count, refreshed_at, latency_ms) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (bucket_name, prefix, period, len(filas), time.time(), latency_ms),
+            )
+
+    def _list_prefix(self, client, bucket_name, zone, year, month, on_object):
+        """
+        Lista un prefijo, entrega cada objeto a ``on_object`` según se descubre y,
+        al terminar, guarda el listado completo junto con su latencia. Si el
+        listado falla, el prefijo queda caducado y se relanza el error.
+        """
+        prefix = composites_prefix(zone, year, month)
+        inicio = time.perf_counter()
+        objetos = []
+        try:
+            for obj in client.list_objects(bucket_name, prefix=prefix, recursive=True):
+                objeto = manifest_object(obj)
+                if objeto is None:
+                    continue
+                objetos.append(objeto)
+                on_object(objeto)
+        except Exception as exc:
+            print(f"裡 Error al listar {prefix}: {exc}")
+            # Sin fila del prefijo, el siguiente ``stale_prefixes`` lo vuelve a listar.
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM prefixes WHERE bucket = ? AND prefix = ?", (bucket_name, prefix)
+                )
+            raise
+        latency_ms = (time.perf_counter() - inicio) * 1000
+        self.store_listing(bucket_name, zone, year, month, objetos, latency_ms)
+        print(f"⏱️ Listado {prefix}: {len(objetos)} objetos en {latency_ms:.0f} ms")
+
+    def _list_concurrently(self, client, bucket_name, pendientes, max_workers):
+        """
+        Lista los prefijos ``pendientes`` en un pool acotado y va devolviendo los
+        objetos a medida que se descubren, sin esperar a que acabe ningún listado.
+        Tras los objetos de cada prefijo listado entero devuelve su ``PrefijoListado``.
+
+        Raises:
+            ListadoError: Al final, si algún prefijo no se ha podido listar. Los
+                demás se han entregado enteros antes.
+        """
+        if not pendientes:
+            return
+        cola = queue.Queue()
+        fin = object()
+        fallidos = []
+
+        def listar(zone, year, month):
+            try:
+                self._list_prefix(client, bucket_name, zone, year, month, cola.put)
+                cola.put(PrefijoListado(zone, int(year), month))
+            except Exception as exc:
+                fallidos.append((PrefijoListado(zone, int(year), month), exc))
+            finally:
+                cola.put(fin)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for zone, year, month in pendientes:
+                executor.submit(listar, zone, year, month)
+            restantes = len(pendientes)
+            while restantes:
+                objeto = cola.get()
+                if objeto is fin:
+                    restantes -= 1
+                else:
+                    yield objeto
+
+        if fallidos:
+            raise ListadoError(prefijo for prefijo, _ in fallidos) from fallidos[0][1]
+
+    def refresh(self, client, bucket_name, zones, year_months, max_workers=LISTING_MAX_WORKERS):
+        """
+        Lista en el bucket, de forma concurrente, sólo los prefijos que faltan o
+        están caducados. Lanza ``ListadoError`` si alguno falla.
+        """
+        pendientes = self.stale_prefixes(bucket_name, zones, year_months)
+        for _ in self._list_concurrently(client, bucket_name, pendientes, max_workers):
+            pass
+
+    def _iter_listado(self, client, bucket_name, zones, year_months, kind, names, max_workers):
+        """
+        Como ``iter_objects``, pero intercala un ``PrefijoListado`` cada vez que un
+        prefijo (zona, año, mes) ya ha entregado todos sus objetos.
+        """
+        pendientes = self.stale_prefixes(bucket_name, zones, year_months)
+        caducados = {(zone, periodo(year, month)) for zone, year, month in pendientes}
+        for obj in self.query(
+            bucket_name,
+            zones,
+            periodo(*year_months[0]),
+            periodo(*year_months[-1]),
+            kind,
+            names,
+        ):
+            if (obj.zone, periodo(obj.year, obj.month)) not in caducados:
+                yield obj
+        # Los prefijos conocidos ya se han entregado enteros con la consulta.
+        for zone in zones:
+            for year, month in year_months:
+                if (zone, periodo(year, month)) not in caducados:
+                    yield PrefijoListado(zone, int(year), month)
+
+        nombres = {n.upper() for n in names}
+        for obj in self._list_concurrently(client, bucket_name, pendientes, max_workers):
+            if isinstance(obj, PrefijoListado):
+                yield obj
+            elif obj.kind == kind and obj.name.upper() in nombres:
+                yield obj
+
+    def iter_objects(
+        self,
+        client,
+        bucket_name,
+        zones,
+        year_months,
+        kind,
+        names,
+        max_workers=LISTING_MAX_WORKERS,
+    ):
+        """
+        Genera los objetos de tipo ``kind`` cuyo nombre está en ``names`` para las
+        zonas y meses pedidos. Primero entrega los ya conocidos por el manifiesto y
+        después los de los prefijos que hay que (re)listar, a medida que el listado
+        concurrente los descubre, para que las descargas empiecen cuanto antes.
+
+        Args:
+            client (Minio): Cliente de MinIO.
+            bucket_name (str): Bucket de composites.
+            zones (list): Zonas UTM.
+            year_months (list): Pares (año, mes en inglés) ordenados.
+            kind (str): ``indexes`` o ``raw``.
+            names (list): Nombres de índice o banda (sin distinguir mayúsculas).
+            max_workers (int): Número máximo de listados simultáneos.
+
+        Yields:
+            ManifestObject: Objetos a descargar.
+
+        Raises:
+            ListadoError: Tras entregar el resto, si algún prefijo no se ha podido
+                listar; sus objetos pueden haberse entregado sólo en parte.
+        """
+        for obj in self._iter_listado(
+            client, bucket_name, zones, year_months, kind, names, max_workers
+        ):
+            if not isinstance(obj, PrefijoListado):
+                yield obj
+
+    def iter_grupos(
+        self,
+        client,
+        bucket_name,
+        zones,
+        year_months,
+        kind,
+        names,
+        agrupar,
+        max_workers=LISTING_MAX_WORKERS,
+    ):
+        """
+        Agrupa con ``agrupar(obj)`` los objetos de ``iter_objects`` y entrega cada
+        grupo en cuanto su mes está listado en todas las zonas, sin esperar al
+        resto del listado. Un grupo no debe mezclar objetos de meses distintos.
+
+        Yields:
+            Tuple[object, list]: Grupo y sus objetos (``ManifestObject``).
+
+        Raises:
+            ListadoError: Tras entregar el resto, si algún prefijo no se ha podido
+                listar. Los grupos de su mes no se entregan. Dentro de un ámbito
+                ``registrar_sin_listar`` no se lanza: el prefijo se anota en él.
+        """
+        zones = list(dict.fromkeys(zones))
+        grupos = defaultdict(list)
+        grupos_mes = defaultdict(dict)
+        zonas_listadas = defaultdict(int)
+        try:
+            for obj in self._iter_listado(
+                client, bucket_name, zones, year_months, kind, names, max_workers
+            ):
+                if not isinstance(obj, PrefijoListado):
+                    grupo = agrupar(obj)
+                    grupos[grupo].append(obj)
+                    grupos_mes[(int(obj.year), obj.month)][grupo] = None
+                    continue
+                mes = (obj.year, obj.month)
+                zonas_listadas[mes] += 1
+                if zonas_listadas[mes] == len(zones):
+                    for grupo in grupos_mes.pop(mes, ()):
+                        yield grupo, grupos.pop(grupo)
+        except ListadoError as exc:
+            sin_listar = _sin_listar.get()
+            if sin_listar is None:
+                raise
+            # El resto de meses ya se ha entregado; los de ``exc`` se omiten.
+            sin_listar.extend(exc.prefijos)
+
+    def listing_latency(self, bucket_name):
+        """
+        Devuelve (número de listados, latencia media y máxima en ms) registrados.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(latency_ms), AVG(latency_ms), MAX(latency_ms) "
+                "FROM prefixes WHERE bucket = ?",
+                (bucket_name,),
+            ).fetchone()
+
+    def query(self, bucket_name, zones, start, end, kind, names):
+        """
+        Devuelve los objetos de tipo ``kind`` (``indexes`` o ``raw``) cuyo nombre
+        está en ``names`` (sin distinguir mayúsculas) para las zonas y el rango
+        de periodos [start, end] (AAAAMM).
+
+        Returns:
+            list[ManifestObject]: Objetos ordenados por zona, periodo y nombre.
+        """
+        zones = list(zones)
+        names = [n.upper() for n in names]
+        if not zones or not names:
+            return []
+        sql = (
+            "SELECT object_name, size, etag, zone, year, month, kind, name, last_modified "
+            "FROM objects "
+            f"WHERE bucket = ? AND kind = ? AND zone IN ({','.join('?' * len(zones))}) "
+            "AND period BETWEEN ? AND ? "
+            f"AND UPPER(name) IN ({','.join('?' * len(names))}) "
+            "ORDER BY zone, period, name"
+        )
+        with self._connect() as conn:
+            filas = conn.execute(sql, [bucket_name, kind, *zones, start, end, *names])
+            return [ManifestObject(*fila) for fila in filas]
+
+    def available_zones(self, bucket_name, zones, start, end):
+        """
+        Devuelve el subconjunto de ``zones`` con algún objeto en el rango de periodos.
+        """
+        zones = list(zones)
+        if not zones:
+            return set()
+        sql = (
+            "SELECT DISTINCT zone FROM objects "
+            f"WHERE bucket = ? AND zone IN ({','.join('?' * len(zones))}) "
+            "AND period BETWEEN ? AND ?"
+        )
+        with self._connect() as conn:
+            return {fila[0] for fila in conn.execute(sql, [bucket_name, *zones, start, end])}
+
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def get_manifest():
+    """
+    Devuelve la instancia de ``BucketManifest`` compartida por todo el proceso.
+    """
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = BucketManifest(MANIFEST_PATH)
+        return _manifest
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import uuid
+
+from dotenv import load_dotenv
+
+from app.merge_pool import map_grupos
+from app.tile_cache import TileCache, _link_or_copy
+
+
+load_dotenv()
+
+MERGE_CACHE_DIR = os.getenv(
+    "MERGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "merge_cache")
+)
+# Presupuesto de la caché de productos fusionados; 0 la desactiva.
+MERGE_CACHE_MAX_BYTES = int(os.getenv("MERGE_CACHE_MAX_BYTES", str(5 * 1024**3)))
+
+
+def merge_cache_enabled():
+    return MERGE_CACHE_MAX_BYTES > 0
+
+
+def clave_producto(bucket_name, producto, year, month_number, objetos, aoi_bounds=None):
+    """
+    Clave de un producto fusionado: bucket, índice o banda, año, mes, límites del
+    AOI (el mosaico se recorta a ellos) y el conjunto ordenado de teselas con sus
+    ETag, de modo que una tesela reescrita en el bucket invalida el producto.
+    """
+    teselas = sorted((obj.object_name, (obj.etag or "").strip('"')) for obj in objetos)
+    contenido = json.dumps(
+        [bucket_name, producto, str(year), month_number, aoi_bounds and list(aoi_bounds), teselas]
+    )
+    return hashlib.sha256(contenido.encode()).hexdigest()
+
+
+def buscar_producto(bucket_name, grupo, objetos, aoi_bounds, destino):
+    """
+    Calcula la clave de un grupo y, si su producto ya está en la caché, lo enlaza
+    en ``destino`` para no descargar sus teselas.
+
+    Args:
+        bucket_name (str): Bucket de las teselas.
+        grupo (tuple): Año, mes e índice o banda.
+        objetos (list): Objetos del manifiesto del grupo, ya listados enteros.
+        aoi_bounds (tuple): Límites del AOI en EPSG:4326, o None.
+        destino (str): Ruta del mosaico del grupo en la carpeta de la petición.
+
+    Returns:
+        Tuple[str, str]: Clave del producto y ``destino`` si se ha servido desde la
+        caché (si no, None). Ambos None si la caché está desactivada.
+    """
+    if not merge_cache_enabled():
+        return None, None
+    year, month_number, producto = grupo
+    clave = clave_producto(bucket_name, producto, year, month_number, objetos, aoi_bounds)
+    ruta = get_merge_cache().obtener(clave, destino)
+    if ruta:
+        print(f"♻️ Mosaico servido desde la caché: {ruta}")
+    return clave, ruta
+
+
+def es_vrt(ruta):
+    return ruta.endswith(".vrt")
+
+
+def materializar(fn, args, destino=None):
+    """
+    Ejecuta la fusión ``fn(*args)`` y, si se indica ``destino``, enlaza en esa
+    ruta el GeoTIFF resultante. Un VRT no se materializa: copiarlo a un GeoTIFF
+    costaría más que el recorte que ahorra, así que se devuelve tal cual y no
+    entra en la caché. Se puede ejecutar en el pool de fusión.
+
+    Returns:
+        str | None: ``destino`` (o la ruta devuelta por ``fn`` si no se indica o
+        es un VRT), o None si la fusión ha fallado.
+    """
+    ruta = fn(*args)
+    if not ruta or destino is None or es_vrt(ruta):
+        return ruta or None
+    _link_or_copy(ruta, destino)
+    return destino
+
+
+def fusionar_grupos(fn, tareas):
+    """
+    Fusiona los grupos de ``tareas`` en el pool de fusión y publica en la caché
+    los productos con clave que se han fusionado como GeoTIFF.
+
+    Args:
+        fn (callable): Función de fusión (a nivel de módulo).
+        tareas (list): Tuplas (grupo, argumentos de ``fn``, clave del producto o
+            None, ruta del mosaico en la carpeta de la petición).
+
+    Returns:
+        list: Pares (grupo, ruta del mosaico o None) en el orden de ``tareas``.
+    """
+    cache = get_merge_cache() if merge_cache_enabled() else None
+    trabajos, publicaciones = [], {}
+    for grupo, args, clave, destino in tareas:
+        tmp_path = None
+        if cache is not None and clave is not None:
+            # El worker escribe el mosaico dentro de la caché y aquí se publica.
+            tmp_path = cache.ruta_temporal(clave)
+            publicaciones[grupo] = (clave, tmp_path, destino)
+        trabajos.append((grupo, (fn, args, tmp_path)))
+
+    resultados = []
+    for grupo, ruta in map_grupos(materializar, trabajos):
+        if grupo in publicaciones:
+            clave, tmp_path, destino = publicaciones[grupo]
+            if ruta and not es_vrt(ruta):
+                ruta = cache.publicar(clave, tmp_path, destino)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        resultados.append((grupo, ruta))
+    return resultados
+
+
+class MergeCache(TileCache):
+    """
+    Caché en disco, compartida por todo el proceso, de los mosaicos fusionados
+    (o recortados al AOI) de cada grupo (índice o banda, año, mes).
+
+    Las entradas se direccionan con ``clave_producto`` y son siempre GeoTIFF: los
+    mosaicos VRT no se guardan. Hereda de ``TileCache`` la publicación atómica y
+    la expulsión LRU.
+    """
+
+    nombre = "caché de productos fusionados"
+
+    def ruta_temporal(self, key):
+        """
+        Ruta dentro de la caché en la que escribir un producto antes de publicarlo.
+        """
+        carpeta = os.path.dirname(self._path(key))
+        os.makedirs(carpeta, exist_ok=True)
+        return os.path.join(carpeta, f"{key}.{uuid.uuid4().hex}.part")
+
+    def obtener(self, key, destino):
+        """
+        Si el producto está en caché lo enlaza en ``destino`` y devuelve su ruta;
+        si no, devuelve None.
+        """
+        ruta = self.get(key)
+        if ruta is None:
+            return None
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        _link_or_copy(ruta, destino)
+        return destino
+
+    def publicar(self, key, tmp_path, destino):
+        """
+        Publica ``tmp_path`` (escrito por ``materializar``) como entrada ``key`` y
+        lo deja también en ``destino``.
+        """
+        ruta = self.put(key, tmp_path)
+        if not os.path.exists(destino):
+            _link_or_copy(ruta, destino)
+        return destino
+
+    def _construir(self, key, fn, args):
+        tmp_path = self.ruta_temporal(key)
+        try:
+            ruta = materializar(fn, args, tmp_path)
+            if ruta is None or es_vrt(ruta):
+                return ruta
+            return self.put(key, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def fusionar(self, key, destino, fn, *args):
+        """
+        Deja en ``destino`` el producto ``key``, sirviéndolo desde la caché o
+        fusionándolo con ``fn(*args)`` y publicándolo. Las peticiones concurrentes
+        del mismo producto esperan a una única fusión.
+
+        Returns:
+            str | None: ``destino``, la ruta del VRT si la fusión ha dado un VRT
+            (que no se publica), o None si la fusión ha fallado.
+        """
+        ruta = self.get(key)
+        if ruta is None:
+            ruta = self._in_flight.do(key, self._construir, key, fn, args)
+        if ruta is None:
+            return None
+        if es_vrt(ruta):
+            # El VRT se escribe junto al mosaico de quien ha fusionado y referencia
+            # sus teselas; una petición que ha esperado a otra fusiona las suyas.
+            if os.path.dirname(ruta) != os.path.dirname(destino):
+                ruta = materializar(fn, args)
+            return ruta
+        if not os.path.exists(destino):
+            _link_or_copy(ruta, destino)
+        return destino
+
+
+_merge_cache = None
+_merge_cache_lock = threading.Lock()
+
+
+def get_merge_cache():
+    """
+    Devuelve la instancia de ``MergeCache`` compartida por todo el proceso.
+    """
+    global _merge_cache
+    with _merge_cache_lock:
+        if _merge_cache is None:
+            _merge_cache = MergeCache(MERGE_CACHE_DIR, MERGE_CACHE_MAX_BYTES)
+        return _merge_cache
@@ -0,0 +1,127 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# "process": las fusiones de cada grupo se reparten entre procesos.
+# "thread": se reparten entre hilos (GDAL suelta el GIL en casi toda la fusión).
+MERGE_POOL = os.getenv("MERGE_POOL", "process")
+MERGE_MAX_WORKERS = int(os.getenv("MERGE_MAX_WORKERS", str(os.cpu_count() or 1)))
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_merge_executor():
+    """
+    Devuelve el pool de fusión compartido por todo el proceso. Los procesos se
+    crean con ``spawn``: el servidor tiene hilos vivos (transferencias, precarga)
+    y un ``fork`` podría heredar sus cerrojos tomados.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            if MERGE_POOL == "process":
+                _executor = ProcessPoolExecutor(
+                    max_workers=MERGE_MAX_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=MERGE_MAX_WORKERS, thread_name_prefix="merge"
+                )
+        return _executor
+
+
+def _descartar_executor(executor):
+    """
+    Olvida ``executor`` si sigue siendo el pool compartido, para que el siguiente
+    ``get_merge_executor`` cree uno nuevo.
+    """
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _cronometrar(fn, args):
+    inicio = time.perf_counter()
+    resultado = fn(*args)
+    return resultado, time.perf_counter() - inicio
+
+
+def _resultado(grupo, fn, *args):
+    """
+    Resultado de un grupo a partir de ``fn(*args)``, que devuelve el par
+    (resultado, segundos) de ``_cronometrar``; None si el grupo ha fallado. Un
+    pool roto no es un fallo del grupo y se propaga.
+    """
+    try:
+        resultado, segundos = fn(*args)
+    except BrokenProcessPool:
+        raise
+    except Exception as e:
+        print(f"❌ Error fusionando el grupo {grupo}: {e}")
+        return None
+    print(f"⏱️ Fusión del grupo {grupo}: {segundos:.2f}s")
+    return resultado
+
+
+def map_grupos(fn, tareas, local=False):
+    """
+    Ejecuta ``fn(*args)`` para cada grupo de ``tareas`` en el pool de fusión y
+    registra el tiempo de cada uno. Si el pool se rompe, se recrea y los grupos
+    afectados se reintentan una vez.
+
+    Args:
+        fn (callable): Función a nivel de módulo (tiene que poder serializarse).
+        tareas (list): Pares (grupo, tupla de argumentos de ``fn``).
+        local (bool): Ejecutar los grupos uno a uno en este hilo, p. ej. si leen
+            o escriben rasters en memoria, que el pool de procesos no ve.
+
+    Returns:
+        list: Pares (grupo, resultado) en el mismo orden que ``tareas``; el
+        resultado es None si el grupo ha fallado.
+    """
+    tareas = list(tareas)
+    if local:
+        return [(grupo, _resultado(grupo, _cronometrar, fn, args)) for grupo, args in tareas]
+
+    resultados = {}
+    pendientes = list(enumerate(tareas))
+    for intento in range(2):
+        executor = get_merge_executor()
+        try:
+            futuros = [
+                (i, executor.submit(_cronometrar, fn, args)) for i, (_, args) in pendientes
+            ]
+        except BrokenProcessPool:
+            futuros = []
+        rotos = [] if futuros else pendientes
+        for i, futuro in futuros:
+            grupo = tareas[i][0]
+            try:
+                resultados[i] = (grupo, _resultado(grupo, futuro.result))
+            except BrokenProcessPool:
+                rotos.append((i, tareas[i]))
+        if not rotos:
+            break
+        # Un worker ha muerto (p. ej. por falta de memoria) y el pool ya no sirve:
+        # se recrea y sus grupos se reintentan una vez.
+        _descartar_executor(executor)
+        if not intento:
+            print(f"⚠️ Pool de fusión roto; se recrea y se reintentan {len(rotos)} grupos.")
+            pendientes = rotos
+            continue
+        for i, (grupo, _) in rotos:
+            print(f"❌ Error fusionando el grupo {grupo}: pool de fusión roto")
+            resultados[i] = (grupo, None)
+    return [resultados[i] for i in range(len(tareas))]
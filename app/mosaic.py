@@ -0,0 +1,273 @@
+import math
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import rasterio
+from dotenv import load_dotenv
+from rasterio.coords import BoundingBox
+from rasterio.merge import merge
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from app.raster_io import RASTER_BLOCKSIZE, en_memoria, raster_writer
+from app.remote_read import REMOTE_READ_MARGIN
+
+
+load_dotenv()
+
+# "vrt": los mosaicos son VRT que referencian las teselas; el recorte lee a
+# través de ellos sólo la ventana que necesita. "gtiff": mosaico materializado.
+MOSAIC_MODE = os.getenv("MOSAIC_MODE", "vrt")
+# Memoria máxima (MB) de cada franja de ``merge_por_bloques``, sea cual sea el
+# tamaño del mosaico.
+MERGE_MEM_LIMIT_MB = int(os.getenv("MERGE_MEM_LIMIT_MB", "64"))
+
+
+class AOIFueraDeImagenes(ValueError):
+    """El AOI no intersecta ninguna de las imágenes del mosaico."""
+
+
+_TIPOS_GDAL = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "uint64": "UInt64",
+    "int64": "Int64",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def vrt_enabled():
+    return MOSAIC_MODE == "vrt"
+
+
+def _valor(valor):
+    return repr(float(valor)) if valor == valor else "nan"
+
+
+def union_bounds(bounds):
+    bounds = list(bounds)
+    return BoundingBox(
+        min(b.left for b in bounds),
+        min(b.bottom for b in bounds),
+        max(b.right for b in bounds),
+        max(b.top for b in bounds),
+    )
+
+
+def aoi_mosaic_bounds(crs, transform, extent, aoi_bounds, margin=REMOTE_READ_MARGIN):
+    """
+    Límites del mosaico recortado al AOI: ``aoi_bounds`` (EPSG:4326) más un margen,
+    pasados al CRS del mosaico, ajustados hacia fuera a la rejilla de píxeles del
+    mosaico completo (origen en la esquina de ``extent`` y resolución de
+    ``transform``) y limitados a ``extent``. Devuelve None si no se solapan.
+    """
+    minx, miny, maxx, maxy = aoi_bounds
+    left, bottom, right, top = transform_bounds(
+        "EPSG:4326", crs, minx - margin, miny - margin, maxx + margin, maxy + margin
+    )
+    xres, yres = transform.a, -transform.e
+    x0, y0 = extent.left, extent.top
+    left = max(extent.left, x0 + math.floor((left - x0) / xres) * xres)
+    right = min(extent.right, x0 + math.ceil((right - x0) / xres) * xres)
+    top = min(extent.top, y0 - math.floor((y0 - top) / yres) * yres)
+    bottom = max(extent.bottom, y0 - math.ceil((y0 - bottom) / yres) * yres)
+    if right <= left or top <= bottom:
+        return None
+    return BoundingBox(left, bottom, right, top)
+
+
+def merge_bounds(datasets, aoi_bounds):
+    """
+    Argumento ``bounds`` de ``rasterio.merge.merge`` para fusionar sólo la zona
+    del AOI, o None si no hay AOI. Lanza ``AOIFueraDeImagenes`` si el AOI no las toca.
+    """
+    if aoi_bounds is None:
+        return None
+    bounds = aoi_mosaic_bounds(
+        datasets[0].crs,
+        datasets[0].transform,
+        union_bounds(ds.bounds for ds in datasets),
+        aoi_bounds,
+    )
+    if bounds is None:
+        raise AOIFueraDeImagenes("El AOI no intersecta ninguna de las imágenes")
+    return tuple(bounds)
+
+
+def filas_por_franja(width, count, dtype, mem_limit_mb=MERGE_MEM_LIMIT_MB):
+    """
+    Filas de cada franja para que la fusión de una franja no pase de
+    ``mem_limit_mb``. ``merge`` tiene a la vez el destino, la ventana leída de
+    cada fuente y sus máscaras, así que se cuentan tres copias por píxel. Si
+    caben, se redondea a múltiplos del bloque de salida.
+    """
+    bytes_fila = 3 * width * count * np.dtype(dtype).itemsize
+    filas = max(1, (mem_limit_mb * 1024**2) // bytes_fila)
+    if filas >= RASTER_BLOCKSIZE:
+        filas -= filas % RASTER_BLOCKSIZE
+    return int(filas)
+
+
+def merge_por_bloques(datasets, salida_path, bounds=None, method="last", mem_limit_mb=MERGE_MEM_LIMIT_MB):
+    """
+    Equivalente a ``rasterio.merge.merge`` seguido de la escritura del mosaico,
+    pero recorriendo la salida por franjas horizontales: para cada franja sólo
+    se leen las ventanas de las fuentes que la tocan y se escribe en disco antes
+    de pasar a la siguiente. La memoria usada depende de ``mem_limit_mb`` y no
+    del tamaño del mosaico, y el resultado es idéntico al de ``merge``.
+
+    Args:
+        datasets (list): Datasets abiertos (mismo CRS y número de bandas).
+        salida_path (str): Ruta del mosaico de salida.
+        bounds (tuple, optional): Límites del mosaico en su CRS; por defecto, la
+            unión de las fuentes.
+        method (str): Método de ``merge`` (``"first"``, ``"last"``...).
+        mem_limit_mb (int): Memoria máxima de cada franja.
+
+    Returns:
+        str: ``salida_path``.
+    """
+    primero = datasets[0]
+    xres, yres = primero.res
+    if bounds is None:
+        bounds = union_bounds(ds.bounds for ds in datasets)
+    left, bottom, right, top = bounds
+    # La misma rejilla que calcula ``merge`` para esos límites.
+    width = int(round((right - left) / xres))
+    height = int(round((top - bottom) / yres))
+    dtype = primero.dtypes[0]
+
+    perfil = primero.profile
+    perfil.update(
+        width=width,
+        height=height,
+        count=primero.count,
+        dtype=dtype,
+        transform=Affine.translation(left, top) * Affine.scale(xres, -yres),
+    )
+    filas = filas_por_franja(width, primero.count, dtype, mem_limit_mb)
+    # La caché de bloques de GDAL (lecturas, escritura y copia a COG) tiene el
+    # mismo límite que cada franja.
+    with rasterio.Env(GDAL_CACHEMAX=mem_limit_mb * 1024**2), raster_writer(salida_path, perfil) as dst:
+        for fila in range(0, height, filas):
+            alto = min(filas, height - fila)
+            franja_top = top - fila * yres
+            franja, _ = merge(
+                datasets,
+                bounds=(left, franja_top - alto * yres, right, franja_top),
+                res=(xres, yres),
+                method=method,
+            )
+            dst.write(franja[:, :alto, :width], window=Window(0, fila, width, alto))
+    return salida_path
+
+
+def build_vrt(rutas, vrt_path, method="last", aoi_bounds=None):
+    """
+    Escribe en ``vrt_path`` un mosaico VRT de ``rutas`` con la misma rejilla que
+    produciría ``rasterio.merge.merge``: resolución, tipo y nodata de la primera
+    imagen y extensión de la unión de todas (o sólo de la zona del AOI).
+
+    Args:
+        rutas (list): Rutas de las imágenes (mismo CRS y número de bandas).
+        vrt_path (str): Ruta del VRT de salida.
+        method (str): ``"last"`` (la última imagen queda encima) o ``"first"``.
+        aoi_bounds (tuple, optional): Límites del AOI en EPSG:4326.
+
+    Returns:
+        str: ``vrt_path``.
+
+    Raises:
+        ValueError: Si las imágenes no comparten CRS o número de bandas.
+        AOIFueraDeImagenes: Si el AOI no intersecta ninguna de las imágenes.
+    """
+    fuentes = []
+    for ruta in rutas:
+        with rasterio.open(ruta) as src:
+            fuentes.append(
+                (os.path.abspath(ruta), src.crs, src.count, src.bounds, src.width,
+                 src.height, src.res, src.dtypes[0], src.nodata)
+            )
+            if len(fuentes) == 1:
+                transform_ref = src.transform
+    _, crs, count, _, _, _, (xres, yres), dtype, nodata = fuentes[0]
+    for ruta, crs_i, count_i, *_ in fuentes[1:]:
+        if crs_i != crs or count_i != count:
+            raise ValueError(f"{ruta} no es compatible con {fuentes[0][0]} para un VRT")
+
+    extent = union_bounds(f[3] for f in fuentes)
+    if aoi_bounds is not None:
+        extent = aoi_mosaic_bounds(crs, transform_ref, extent, aoi_bounds)
+        if extent is None:
+            raise AOIFueraDeImagenes("El AOI no intersecta ninguna de las imágenes")
+        fuentes = [
+            f for f in fuentes
+            if f[3].left < extent.right and f[3].right > extent.left
+            and f[3].bottom < extent.top and f[3].top > extent.bottom
+        ]
+    left, bottom, right, top = extent
+    width = int(round((right - left) / xres))
+    height = int(round((top - bottom) / yres))
+
+    vrt = ET.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(vrt, "SRS").text = crs.to_wkt()
+    ET.SubElement(vrt, "GeoTransform").text = f"{left!r}, {xres!r}, 0.0, {top!r}, 0.0, {-yres!r}"
+    # En un VRT la última fuente se pinta encima, como en ``merge(method="last")``.
+    orden = fuentes if method == "last" else fuentes[::-1]
+    for banda in range(1, count + 1):
+        elemento = ET.SubElement(
+            vrt, "VRTRasterBand", dataType=_TIPOS_GDAL[dtype], band=str(banda)
+        )
+        if nodata is not None:
+            ET.SubElement(elemento, "NoDataValue").text = _valor(nodata)
+        for ruta, _, _, bounds, w, h, _, _, nodata_i in orden:
+            fuente = ET.SubElement(
+                elemento, "ComplexSource" if nodata_i is not None else "SimpleSource"
+            )
+            ET.SubElement(fuente, "SourceFilename", relativeToVRT="0").text = ruta
+            ET.SubElement(fuente, "SourceBand").text = str(banda)
+            ET.SubElement(fuente, "SrcRect", xOff="0", yOff="0", xSize=str(w), ySize=str(h))
+            ET.SubElement(
+                fuente,
+                "DstRect",
+                xOff=repr((bounds.left - left) / xres),
+                yOff=repr((top - bounds.top) / yres),
+                xSize=repr((bounds.right - bounds.left) / xres),
+                ySize=repr((bounds.top - bounds.bottom) / yres),
+            )
+            if nodata_i is not None:
+                ET.SubElement(fuente, "NODATA").text = _valor(nodata_i)
+
+    ET.ElementTree(vrt).write(vrt_path)
+    return vrt_path
+
+
+def write_vrt_mosaic(rutas, salida_path, method="last", aoi_bounds=None):
+    """
+    Si ``MOSAIC_MODE`` es ``vrt``, escribe el mosaico de ``rutas`` como VRT junto a
+    ``salida_path`` (con extensión ``.vrt``), limitado al AOI si se indica, y
+    devuelve su ruta. Devuelve None si el modo VRT está desactivado o las
+    imágenes no admiten un VRT, para que el llamador materialice el mosaico con
+    ``merge``. Los mosaicos en memoria no usan VRT.
+
+    Raises:
+        AOIFueraDeImagenes: Si el AOI no intersecta ninguna de las imágenes; un
+            GeoTIFF tampoco tendría nada que fusionar.
+    """
+    if not vrt_enabled() or en_memoria(salida_path):
+        return None
+    vrt_path = f"{os.path.splitext(salida_path)[0]}.vrt"
+    try:
+        return build_vrt(rutas, vrt_path, method, aoi_bounds)
+    except AOIFueraDeImagenes:
+        raise
+    except ValueError as e:
+        print(f"⚠️ {e}; se fusiona en GeoTIFF.")
+        return None
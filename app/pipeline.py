@@ -0,0 +1,289 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from dotenv import load_dotenv
+
+from app import download_merge_rgb
+from app.cut_from_geometry import cut_from_geometries, geometries_to_gdf
+from app.download_merge import (
+    BUCKET_NAME,
+    convertir_mes_a_numero,
+    download_tif_file,
+    merge_tifs,
+    rango_year_months,
+)
+from app.download_merge_rgb import (
+    descargar_archivo,
+    generar_rango_fechas,
+    merge_tifs_por_fecha_banda,
+    rgb,
+)
+from app.generate_map import guardar_gif, merge_tifs_por_fecha, render_frame_no_rgb
+from app.manifest import get_manifest
+from app.merge_cache import buscar_producto, get_merge_cache
+from app.raster_io import carpeta_temporal, en_ambito
+from app.storage import TransferJob, get_minio_client
+
+
+load_dotenv()
+
+# "streaming": cada grupo (índice, año, mes) pasa a fusión, recorte y render en
+# cuanto terminan sus descargas. "phased": descarga todo, luego fusiona todo, etc.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "streaming")
+PIPELINE_STAGE_WORKERS = int(os.getenv("PIPELINE_STAGE_WORKERS", "4"))
+
+
+def pipeline_enabled():
+    return PIPELINE_MODE == "streaming"
+
+
+def ejecutar_por_grupos(grupos, descargar, procesar_grupo):
+    """
+    Descarga los objetos de cada grupo y, desde la última de sus descargas en
+    terminar, lanza ``procesar_grupo`` para el grupo mientras el resto sigue
+    descargándose y listándose. Los grupos sin descargas se procesan en cuanto llegan.
+
+    Args:
+        grupos (iterable): Pares (grupo, lista de argumentos de ``descargar``). Se
+            consume a medida que se generan, así que las descargas empiezan durante
+            el listado.
+        descargar (callable): Función que descarga un objeto.
+        procesar_grupo (callable): Función que recibe un grupo y devuelve su resultado.
+
+    Returns:
+        dict: Resultado de ``procesar_grupo`` por grupo. Los grupos con alguna
+        descarga fallida (tras agotar los reintentos) no se procesan.
+    """
+    resultados = {}
+    # Los recortes de cada grupo se crean en el ámbito de la petición.
+    procesar_grupo = en_ambito(procesar_grupo)
+    pendientes, incompletos = {}, set()
+    lock = threading.Lock()
+    # Cada grupo despachado deja aquí su futuro de etapa, o None si no se procesa.
+    despachados = queue.Queue()
+    with TransferJob() as descargas, \
+         ThreadPoolExecutor(max_workers=PIPELINE_STAGE_WORKERS) as etapas:
+
+        def despachar(grupo):
+            futuro = None
+            if grupo in incompletos:
+                # Un mosaico con teselas de menos daría un resultado engañoso.
+                print(f"❌ Faltan objetos del grupo {grupo}, no se procesa.")
+            else:
+                try:
+                    futuro = etapas.submit(procesar_grupo, grupo)
+                except Exception as e:
+                    print(f"❌ Error procesando el grupo {grupo}: {e}")
+            despachados.put((grupo, futuro))
+
+        def descarga_terminada(grupo, futuro):
+            # Se ejecuta en el hilo de la descarga; el último de un grupo lo despacha.
+            try:
+                futuro.result()
+            except Exception as e:
+                print(f"Error descargando archivo del grupo {grupo}: {e}")
+                with lock:
+                    incompletos.add(grupo)
+            with lock:
+                pendientes[grupo] -= 1
+                ultimo = pendientes[grupo] == 0
+            if ultimo:
+                despachar(grupo)
+
+        n_grupos = 0
+        for grupo, tareas in grupos:
+            n_grupos += 1
+            if not tareas:
+                despachar(grupo)
+                continue
+            # El listado del grupo está completo: se conoce ya su número de descargas.
+            with lock:
+                pendientes[grupo] = len(tareas)
+            for args in tareas:
+                descargas.submit(descargar, *args).add_done_callback(
+                    partial(descarga_terminada, grupo)
+                )
+
+        for _ in range(n_grupos):
+            grupo, futuro = despachados.get()
+            if futuro is None:
+                continue
+            try:
+                resultados[grupo] = futuro.result()
+            except Exception as e:
+                print(f"❌ Error procesando el grupo {grupo}: {e}")
+    return resultados
+
+
+def recortar(ruta, features):
+    # El mosaico puede ser un GeoTIFF o un VRT; los recortes siempre son GeoTIFF.
+    formato = os.path.splitext(ruta)[1][1:]
+    if not features:
+        return []
+    geometries, geometry_ids = zip(*features)
+    recortes = cut_from_geometries(geometries_to_gdf(list(geometries)), formato, [ruta], geometry_ids)
+    return [recorte for recortes_feature in recortes for recorte in recortes_feature]
+
+
+def _pipeline_indices(utm_zones, years, months, indexes, features, aoi_bounds, merge_crops):
+    local_download_path = carpeta_temporal()
+    client = get_minio_client()
+
+    def carpeta_de(grupo):
+        year, month_number, index = grupo
+        return os.path.join(local_download_path, str(year), index, month_number)
+
+    def ruta_de(grupo):
+        year, month_number, index = grupo
+        return os.path.join(carpeta_de(grupo), f"{index}_{year}_{month_number}.tif")
+
+    claves, servidos = {}, {}
+
+    def grupos():
+        # Cada grupo se busca en la caché en cuanto su mes está listado.
+        for grupo, objetos in get_manifest().iter_grupos(
+            client,
+            BUCKET_NAME,
+            utm_zones,
+            rango_year_months(years, months),
+            "indexes",
+            indexes,
+            lambda obj: (obj.year, convertir_mes_a_numero(obj.month), obj.name.upper()),
+        ):
+            claves[grupo], servidos[grupo] = buscar_producto(
+                BUCKET_NAME, grupo, objetos, aoi_bounds, ruta_de(grupo)
+            )
+            if servidos[grupo]:
+                yield grupo, []
+                continue
+            download_dir = carpeta_de(grupo)
+            os.makedirs(download_dir, exist_ok=True)
+            yield grupo, [
+                (client, BUCKET_NAME, obj, download_dir, aoi_bounds) for obj in objetos
+            ]
+
+    def procesar_grupo(grupo):
+        carpeta_mes = carpeta_de(grupo)
+        merge_path = ruta_de(grupo)
+        if servidos[grupo]:
+            merge_path = servidos[grupo]
+        elif claves[grupo]:
+            merge_path = get_merge_cache().fusionar(
+                claves[grupo], merge_path, merge_tifs, carpeta_mes, merge_path, 4326, aoi_bounds
+            )
+        else:
+            merge_path = merge_tifs(carpeta_mes, merge_path, aoi_bounds=aoi_bounds)
+        if not merge_path:
+            print(f"❌ No se pudo fusionar TIFFs en: {carpeta_mes}")
+            return [], []
+        recortes = recortar(merge_path, features)
+        if merge_crops:
+            recortes = merge_tifs_por_fecha(recortes)
+        return recortes, [render_frame_no_rgb(recorte) for recorte in recortes]
+
+    resultados = ejecutar_por_grupos(grupos(), download_tif_file, procesar_grupo)
+
+    recortes, frames = [], []
+    for grupo in sorted(resultados):
+        recortes.extend(resultados[grupo][0])
+        frames.extend(resultados[grupo][1])
+    if not frames:
+        return [], None
+    return recortes, guardar_gif(frames)
+
+
+def _pipeline_rgb(utm_zones, years, months, features, aoi_bounds, merge_crops):
+    local_download_path = carpeta_temporal()
+    bandas = ["B02_20m", "B03_20m", "B04_20m"]
+    client = get_minio_client()
+
+    def carpeta_de(grupo):
+        year, month_number, banda = grupo
+        return os.path.join(local_download_path, str(year), banda, month_number)
+
+    def ruta_de(grupo):
+        year, month_number, banda = grupo
+        return download_merge_rgb.ruta_merge(carpeta_de(grupo), year, banda, month_number)
+
+    claves, servidos = {}, {}
+
+    def grupos():
+        # Cada grupo se busca en la caché en cuanto su mes está listado.
+        for grupo, objetos in get_manifest().iter_grupos(
+            client,
+            download_merge_rgb.bucket_name,
+            utm_zones,
+            generar_rango_fechas(years, months),
+            "raw",
+            bandas,
+            lambda obj: (
+                obj.year, download_merge_rgb.convertir_mes_a_numero(obj.month), obj.name
+            ),
+        ):
+            claves[grupo], servidos[grupo] = buscar_producto(
+                download_merge_rgb.bucket_name, grupo, objetos, aoi_bounds, ruta_de(grupo)
+            )
+            if servidos[grupo]:
+                yield grupo, []
+                continue
+            download_dir = carpeta_de(grupo)
+            os.makedirs(download_dir, exist_ok=True)
+            yield grupo, [
+                (client, obj, os.path.join(download_dir, f"{obj.zone}.tif"), aoi_bounds)
+                for obj in objetos
+            ]
+
+    def procesar_grupo(grupo):
+        year, month_number, banda = grupo
+        carpeta_mes = carpeta_de(grupo)
+        args = (carpeta_mes, year, banda, month_number, aoi_bounds)
+        if servidos[grupo]:
+            merge_path = servidos[grupo]
+        elif claves[grupo]:
+            merge_path = get_merge_cache().fusionar(
+                claves[grupo], ruta_de(grupo), download_merge_rgb.merge_tifs, *args
+            )
+        else:
+            merge_path = download_merge_rgb.merge_tifs(*args)
+        if not merge_path:
+            return []
+        recortes = recortar(merge_path, features)
+        if merge_crops:
+            recortes = merge_tifs_por_fecha_banda(recortes)
+        return recortes
+
+    resultados = ejecutar_por_grupos(grupos(), descargar_archivo, procesar_grupo)
+
+    recortes = [recorte for grupo in sorted(resultados) for recorte in resultados[grupo]]
+    if not recortes:
+        return [], None
+    # La composición RGB necesita las tres bandas de cada fecha; se hace al final
+    # sobre los recortes, que son pequeños.
+    rgb_folder, rutas_png, rutas_tif_rgb, output_gif = rgb(recortes)
+    return recortes, output_gif
+
+
+def run_sentinel_pipeline(utm_zones, years, months, indexes, features, aoi_bounds, merge_crops):
+    """
+    Ejecuta descarga, fusión, recorte y render por grupos (índice o banda, año y
+    mes), solapando el trabajo de red, CPU y disco de grupos distintos.
+
+    Args:
+        utm_zones (list): Zonas UTM.
+        years (list): Año inicial y final.
+        months (list): Mes inicial y final (nombres en inglés).
+        indexes (list): Índices a procesar, o ["RGB"].
+        features (list): Pares (geometría GeoJSON, identificador) a recortar.
+        aoi_bounds (tuple): Límites del AOI en EPSG:4326.
+        merge_crops (bool): Si se fusionan por fecha los recortes de todas las geometrías.
+
+    Returns:
+        Tuple[list, str]: Rutas de los recortes (ordenados por fecha) y ruta del GIF,
+        o ([], None) si no hay imágenes disponibles.
+    """
+    if indexes == ["RGB"]:
+        return _pipeline_rgb(utm_zones, years, months, features, aoi_bounds, merge_crops)
+    return _pipeline_indices(utm_zones, years, months, indexes, features, aoi_bounds, merge_crops)
@@ -0,0 +1,153 @@
+import os
+import threading
+from datetime import date
+
+from dotenv import load_dotenv
+
+from app import download_merge_rgb
+from app.download_merge import BUCKET_NAME
+from app.manifest import MESES_INGLES, get_manifest, periodo
+from app.storage import TransferJob, get_minio_client
+from app.tile_cache import TILE_CACHE_MAX_BYTES, get_tile_cache
+
+
+load_dotenv()
+
+# Teselas UTM más pedidas, de mayor a menor prioridad. Vacío desactiva la precarga.
+PREFETCH_ZONES = [z.strip() for z in os.getenv("PREFETCH_ZONES", "").split(",") if z.strip()]
+# Productos a precargar, de mayor a menor prioridad. "RGB" son las tres bandas raw.
+PREFETCH_PRODUCTS = [
+    p.strip()
+    for p in os.getenv("PREFETCH_PRODUCTS", "ndvi,RGB,ndwi,moisture,evi").split(",")
+    if p.strip()
+]
+# Bytes máximos a descargar en cada pasada (sin contar lo que ya está en caché).
+PREFETCH_MAX_BYTES = int(os.getenv("PREFETCH_MAX_BYTES", str(TILE_CACHE_MAX_BYTES // 4)))
+# Segundos entre pasadas; 0 sólo precarga al arrancar.
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", "21600"))
+# Transferencias en vuelo de la precarga, para no quitar ancho de banda a los usuarios.
+PREFETCH_MAX_IN_FLIGHT = int(os.getenv("PREFETCH_MAX_IN_FLIGHT", "2"))
+
+BANDAS_RGB = ["B02_20m", "B03_20m", "B04_20m"]
+
+_parar = threading.Event()
+_hilo = None
+
+
+def meses_candidatos(hoy=None, meses=3):
+    """
+    Pares (año, mes en inglés) desde el mes en curso hacia atrás. Los composites
+    se generan a final de mes, así que el último disponible suele ser el anterior.
+    """
+    hoy = hoy or date.today()
+    year, month = hoy.year, hoy.month
+    candidatos = []
+    for _ in range(meses):
+        candidatos.append((year, MESES_INGLES[month - 1]))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return candidatos
+
+
+def ultimo_mes(client, manifest, zones):
+    """
+    Devuelve el (año, mes) más reciente con composites de índices para ``zones``,
+    o None si no hay ninguno entre los candidatos.
+    """
+    for year, month in meses_candidatos():
+        manifest.refresh(client, BUCKET_NAME, zones, [(year, month)])
+        p = periodo(year, month)
+        if manifest.available_zones(BUCKET_NAME, zones, p, p):
+            return year, month
+    return None
+
+
+def objetos_prioritarios(manifest, zones, year, month, products=PREFETCH_PRODUCTS):
+    """
+    Genera (bucket, objeto) en orden de prioridad: primero por producto y, dentro
+    de cada producto, por zona, en el orden en que se han configurado.
+    """
+    p = periodo(year, month)
+    rango_zona = {zone: i for i, zone in enumerate(zones)}
+    for producto in products:
+        if producto.upper() == "RGB":
+            bucket_name, kind, names = download_merge_rgb.bucket_name, "raw", BANDAS_RGB
+        else:
+            bucket_name, kind, names = BUCKET_NAME, "indexes", [producto]
+        objetos = manifest.query(bucket_name, zones, p, p, kind, names)
+        for obj in sorted(objetos, key=lambda o: rango_zona[o.zone]):
+            yield bucket_name, obj
+
+
+def prefetch(zones=PREFETCH_ZONES, max_bytes=PREFETCH_MAX_BYTES):
+    """
+    Descarga a la caché de teselas los composites del último mes disponible para
+    las teselas más pedidas, por orden de prioridad y sin pasar de ``max_bytes``.
+
+    Returns:
+        dict: Mes precargado, objetos descargados, ya en caché y omitidos por presupuesto.
+    """
+    client = get_minio_client()
+    manifest = get_manifest()
+    cache = get_tile_cache()
+    mes = ultimo_mes(client, manifest, zones)
+    if mes is None:
+        print(f"⚠️ Precarga: no hay composites recientes para {zones}")
+        return {"mes": None, "descargados": 0, "en_cache": 0, "omitidos": 0}
+
+    year, month = mes
+    manifest.refresh(client, download_merge_rgb.bucket_name, zones, [mes])
+    presupuesto = max_bytes
+    descargas, en_cache, omitidos = [], 0, 0
+    with TransferJob(max_in_flight=PREFETCH_MAX_IN_FLIGHT) as job:
+        for bucket_name, obj in objetos_prioritarios(manifest, zones, year, month):
+            if _parar.is_set():
+                break
+            if cache.contains(bucket_name, obj.object_name, obj.etag):
+                en_cache += 1
+                continue
+            if obj.size > presupuesto:
+                omitidos += 1
+                continue
+            presupuesto -= obj.size
+            descargas.append(job.submit(cache.warm, client, bucket_name, obj))
+        for futuro in descargas:
+            try:
+                futuro.result()
+            except Exception as e:
+                print(f"❌ Precarga fallida: {e}")
+
+    resumen = {
+        "mes": f"{month} {year}",
+        "descargados": len(descargas),
+        "en_cache": en_cache,
+        "omitidos": omitidos,
+    }
+    print(f"🔥 Precarga completada: {resumen}")
+    return resumen
+
+
+def _bucle():
+    while not _parar.is_set():
+        try:
+            prefetch()
+        except Exception as e:
+            print(f"❌ Error en la precarga: {e}")
+        if PREFETCH_INTERVAL <= 0:
+            return
+        _parar.wait(PREFETCH_INTERVAL)
+
+
+def iniciar_prefetch():
+    """
+    Arranca la precarga en un hilo en segundo plano, si hay teselas configuradas.
+    """
+    global _hilo
+    if not PREFETCH_ZONES or (_hilo is not None and _hilo.is_alive()):
+        return
+    _parar.clear()
+    _hilo = threading.Thread(target=_bucle, name="prefetch", daemon=True)
+    _hilo.start()
+
+
+def detener_prefetch():
+    _parar.set()
@@ -0,0 +1,246 @@
+import contextvars
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from dotenv import load_dotenv
+from rasterio.io import MemoryFile
+
+
+load_dotenv()
+
+# "COG": GeoTIFF optimizado para la nube (teselado, comprimido y con overviews
+# internas). "GTiff": GeoTIFF teselado y comprimido, sin overviews.
+RASTER_FORMAT = os.getenv("RASTER_FORMAT", "COG")
+RASTER_COMPRESS = os.getenv("RASTER_COMPRESS", "DEFLATE")
+# "YES" elige el predictor según el tipo: de coma flotante (3) para los índices
+# y horizontal (2) para las bandas enteras.
+RASTER_PREDICTOR = os.getenv("RASTER_PREDICTOR", "YES")
+RASTER_BLOCKSIZE = int(os.getenv("RASTER_BLOCKSIZE", "512"))
+RASTER_OVERVIEWS = os.getenv("RASTER_OVERVIEWS", "AUTO")
+# "memory": dentro de ``rasters_intermedios`` los rasters intermedios (recortes,
+# sus mosaicos y las composiciones RGB) se pasan entre etapas en memoria
+# (/vsimem) y no tocan el disco. "disk": se escriben en el directorio temporal.
+RASTER_HANDOFF = os.getenv("RASTER_HANDOFF", "memory")
+
+# Claves del perfil de origen que describen su estructura en disco, no los datos.
+_CLAVES_ESTRUCTURA = (
+    "driver", "tiled", "blockxsize", "blockysize", "compress", "predictor",
+    "interleave", "photometric", "zlevel",
+)
+
+
+_ambito = contextvars.ContextVar("rasters_intermedios", default=None)
+# Carpetas temporales en disco del ámbito actual, que se borran al salir de él.
+_carpetas = contextvars.ContextVar("carpetas_temporales", default=None)
+
+
+class _Ambito:
+    def __init__(self):
+        self.carpeta = f"/vsimem/intermedios_{uuid.uuid4().hex}"
+        self.rutas = set()
+        self.lock = threading.Lock()
+
+
+def en_memoria(path):
+    return str(path).startswith("/vsimem/")
+
+
+def remove_raster(path):
+    """
+    Borra el raster ``path``, esté en disco o en memoria.
+    """
+    if en_memoria(path):
+        if rasterio.shutil.exists(path):
+            rasterio.shutil.delete(path)
+    else:
+        os.remove(path)
+
+
+@contextmanager
+def rasters_intermedios():
+    """
+    Ámbito (p. ej. una petición) cuyos rasters intermedios se crean en memoria
+    con ``intermediate_path`` y se liberan todos al salir, igual que las
+    carpetas de ``carpeta_temporal``. Sirve también como decorador. Con
+    ``RASTER_HANDOFF=disk`` los intermedios van a disco y sólo se borran las
+    carpetas.
+    """
+    ambito = _Ambito() if RASTER_HANDOFF == "memory" else None
+    carpetas = []
+    token = _ambito.set(ambito)
+    token_carpetas = _carpetas.set(carpetas)
+    try:
+        yield
+    finally:
+        _ambito.reset(token)
+        _carpetas.reset(token_carpetas)
+        for ruta in ambito.rutas if ambito else ():
+            try:
+                remove_raster(ruta)
+            except Exception:
+                pass
+        for carpeta in carpetas:
+            shutil.rmtree(carpeta, ignore_errors=True)
+
+
+def carpeta_temporal():
+    """
+    Crea una carpeta temporal en disco que se borra al salir del ámbito
+    ``rasters_intermedios`` actual. Fuera de un ámbito no se borra.
+    """
+    carpeta = tempfile.mkdtemp()
+    carpetas = _carpetas.get()
+    if carpetas is not None:
+        carpetas.append(carpeta)
+    return carpeta
+
+
+def en_ambito(fn):
+    """
+    Envuelve ``fn`` para que, ejecutada en otro hilo, cree sus intermedios en
+    el ámbito actual (los hilos de un pool no heredan el contexto).
+    """
+    ambito = _ambito.get()
+    carpetas = _carpetas.get()
+
+    def ejecutar(*args, **kwargs):
+        token = _ambito.set(ambito)
+        token_carpetas = _carpetas.set(carpetas)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _ambito.reset(token)
+            _carpetas.reset(token_carpetas)
+
+    return ejecutar
+
+
+def intermedios_en_memoria():
+    return _ambito.get() is not None
+
+
+def intermediate_path(filename, directorio=None):
+    """
+    Ruta para un raster intermedio llamado ``filename``: en memoria dentro de un
+    ámbito ``rasters_intermedios``, o en ``directorio`` (por defecto el
+    temporal) fuera de él. Los rasters en memoria sólo son visibles en este
+    proceso.
+    """
+    ambito = _ambito.get()
+    if ambito is None:
+        return os.path.join(directorio or tempfile.gettempdir(), filename)
+    ruta = f"{ambito.carpeta}/{filename}"
+    with ambito.lock:
+        ambito.rutas.add(ruta)
+    return ruta
+
+
+def _predictor(dtype):
+    if RASTER_PREDICTOR.upper() != "YES":
+        return RASTER_PREDICTOR
+    return "3" if np.issubdtype(np.dtype(dtype), np.floating) else "2"
+
+
+def _es_cog():
+    return RASTER_FORMAT.upper() == "COG"
+
+
+def creation_options(dtype, driver=None):
+    """
+    Opciones de creación del formato configurado (o de ``driver``, si se indica)
+    para un raster de tipo ``dtype``.
+    """
+    driver = driver or ("COG" if _es_cog() else "GTiff")
+    if driver == "COG":
+        return {
+            "driver": "COG",
+            "COMPRESS": RASTER_COMPRESS,
+            "PREDICTOR": RASTER_PREDICTOR,
+            "BLOCKSIZE": RASTER_BLOCKSIZE,
+            "OVERVIEWS": RASTER_OVERVIEWS,
+        }
+    return {
+        "driver": "GTiff",
+        "TILED": "YES",
+        "BLOCKXSIZE": RASTER_BLOCKSIZE,
+        "BLOCKYSIZE": RASTER_BLOCKSIZE,
+        "COMPRESS": RASTER_COMPRESS,
+        "PREDICTOR": _predictor(dtype),
+    }
+
+
+def copy_raster(origen, destino):
+    """
+    Copia ``origen`` (ruta o dataset abierto, p. ej. un VRT) en ``destino`` con
+    el formato configurado.
+    """
+    if isinstance(origen, str):
+        with rasterio.open(origen) as src:
+            return copy_raster(src, destino)
+    rasterio.shutil.copy(origen, destino, **creation_options(origen.dtypes[0]))
+    return destino
+
+
+def write_raster(path, data, profile):
+    """
+    Escribe el array ``data`` (bandas, filas, columnas) en ``path`` con el formato
+    configurado. De ``profile`` se toman el georreferenciado, el tipo y el
+    nodata; la estructura en disco (teselas, compresión) es siempre la nuestra.
+    """
+    perfil = {k: v for k, v in profile.items() if k not in _CLAVES_ESTRUCTURA}
+    perfil.update(count=data.shape[0], height=data.shape[1], width=data.shape[2])
+    perfil.setdefault("dtype", data.dtype)
+
+    opciones = creation_options(perfil["dtype"])
+    if opciones["driver"] != "COG":
+        with rasterio.open(path, "w", **perfil, **opciones) as dst:
+            dst.write(data)
+        return path
+
+    # El driver COG sólo sabe copiar un dataset existente, así que los datos se
+    # escriben antes en un GeoTIFF en memoria (/vsimem).
+    with MemoryFile() as memoria:
+        with memoria.open(driver="GTiff", **perfil) as tmp:
+            tmp.write(data)
+            copy_raster(tmp, path)
+    return path
+
+
+@contextmanager
+def raster_writer(path, profile):
+    """
+    Abre ``path`` para escribirlo por ventanas con el formato configurado, sin
+    tener el raster entero en memoria. ``profile`` debe traer ya el tamaño final.
+
+    Con COG se escribe primero un GeoTIFF teselado junto a ``path`` y al cerrar
+    se copia a COG, que GDAL hace también bloque a bloque.
+    """
+    perfil = {k: v for k, v in profile.items() if k not in _CLAVES_ESTRUCTURA}
+    opciones = creation_options(perfil["dtype"], driver="GTiff")
+    if not _es_cog():
+        with rasterio.open(path, "w", **perfil, **opciones) as dst:
+            yield dst
+        return
+
+    # El GeoTIFF intermedio va sin comprimir: sólo vive hasta la copia y así los
+    # datos se comprimen una vez, no dos.
+    opciones["COMPRESS"] = "NONE"
+    opciones.pop("PREDICTOR")
+    if en_memoria(path):
+        tmp_path = f"{os.path.splitext(path)[0]}.{uuid.uuid4().hex}.tif"
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tif")
+        os.close(fd)
+    try:
+        with rasterio.open(tmp_path, "w", **perfil, **opciones) as dst:
+            yield dst
+        copy_raster(tmp_path, path)
+    finally:
+        remove_raster(tmp_path)
@@ -0,0 +1,145 @@
+import math
+import os
+
+import rasterio
+from dotenv import load_dotenv
+from rasterio.session import Session
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+from app.raster_io import write_raster
+from app.storage import dataset_path
+
+
+load_dotenv()
+
+MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
+MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
+MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
+
+# "auto": lee sólo la ventana del AOI cuando el objeto está teselado internamente.
+# "off": descarga siempre el objeto completo.
+REMOTE_READ_MODE = os.getenv("REMOTE_READ_MODE", "auto")
+# Margen (en grados) que se añade alrededor de los límites del AOI.
+REMOTE_READ_MARGIN = float(os.getenv("REMOTE_READ_MARGIN", "0.001"))
+
+
+# Resultados de ``read_window``.
+VENTANA_LEIDA = "leida"
+SIN_TESELAR = "sin_teselar"
+FUERA_DEL_AOI = "fuera_del_aoi"
+
+
+def remote_read_enabled(aoi_bounds):
+    return aoi_bounds is not None and REMOTE_READ_MODE != "off"
+
+
+class MinioSession(Session):
+    """
+    Sesión de rasterio que pasa las credenciales de MinIO a GDAL como opciones de
+    configuración. ``rasterio.Env`` no admite ``AWS_ACCESS_KEY_ID`` como opción
+    directa y ``AWSSession`` exige boto3, que la aplicación no usa.
+    """
+
+    def __init__(self, endpoint, access_key, secret_key):
+        self.endpoint = endpoint
+        self.access_key = access_key
+        self.secret_key = secret_key
+
+    @classmethod
+    def hascreds(cls, config):
+        return "AWS_ACCESS_KEY_ID" in config and "AWS_SECRET_ACCESS_KEY" in config
+
+    @property
+    def credentials(self):
+        return {
+            "aws_access_key_id": self.access_key,
+            "aws_secret_access_key": self.secret_key,
+        }
+
+    def get_credential_options(self):
+        return {
+            "AWS_ACCESS_KEY_ID": self.access_key,
+            "AWS_SECRET_ACCESS_KEY": self.secret_key,
+            "AWS_S3_ENDPOINT": self.endpoint,
+            "AWS_HTTPS": "NO",
+            "AWS_VIRTUAL_HOSTING": "FALSE",
+        }
+
+
+def s3_env():
+    """
+    Entorno GDAL para abrir objetos de MinIO a través de /vsis3/ con peticiones por rangos.
+    """
+    return rasterio.Env(
+        session=MinioSession(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY),
+        GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+        CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".tif",
+        GDAL_HTTP_MAX_RETRY=3,
+        GDAL_HTTP_RETRY_DELAY=1,
+    )
+
+
+def is_internally_tiled(src):
+    """
+    Indica si el dataset está teselado internamente; en un GeoTIFF por tiras cada
+    lectura de ventana arrastra filas completas y no compensa leer en remoto.
+    """
+    return bool(src.profile.get("tiled", False))
+
+
+def aoi_window(src, aoi_bounds, margin=REMOTE_READ_MARGIN):
+    """
+    Calcula la ventana de píxeles del dataset que cubre ``aoi_bounds`` (EPSG:4326)
+    más un margen, redondeada hacia fuera y recortada a la extensión del raster.
+    Devuelve None si el AOI no intersecta el raster.
+    """
+    minx, miny, maxx, maxy = aoi_bounds
+    left, bottom, right, top = transform_bounds(
+        "EPSG:4326", src.crs, minx - margin, miny - margin, maxx + margin, maxy + margin
+    )
+    window = from_bounds(left, bottom, right, top, transform=src.transform)
+    col_start = max(0, math.floor(window.col_off))
+    row_start = max(0, math.floor(window.row_off))
+    col_stop = min(src.width, math.ceil(window.col_off + window.width))
+    row_stop = min(src.height, math.ceil(window.row_off + window.height))
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def read_window(bucket_name, object_name, aoi_bounds, local_file_path):
+    """
+    Lee del bucket sólo la ventana de ``object_name`` que cubre el AOI y la guarda
+    como GeoTIFF en ``local_file_path``.
+
+    Args:
+        bucket_name (str): Bucket de MinIO.
+        object_name (str): Nombre del objeto dentro del bucket.
+        aoi_bounds (tuple): Límites del AOI (minx, miny, maxx, maxy) en EPSG:4326.
+        local_file_path (str): Ruta local del GeoTIFF de salida.
+
+    Returns:
+        str: ``VENTANA_LEIDA`` si se ha escrito la ventana, ``FUERA_DEL_AOI`` si
+        el AOI no intersecta el raster (no se escribe nada y el objeto no hace
+        falta) o ``SIN_TESELAR`` si el objeto no está teselado y hay que
+        descargarlo completo.
+    """
+    with s3_env():
+        with rasterio.open(dataset_path(bucket_name, object_name)) as src:
+            if not is_internally_tiled(src):
+                print(f"⚠️ {object_name} no está teselado, se descargará completo.")
+                return SIN_TESELAR
+
+            window = aoi_window(src, aoi_bounds)
+            if window is None:
+                print(f"⚠️ El AOI no intersecta {object_name}, se omite.")
+                return FUERA_DEL_AOI
+
+            data = src.read(window=window)
+            profile = src.profile.copy()
+            profile.update(transform=src.window_transform(window))
+
+    write_raster(local_file_path, data, profile)
+    print(f"✅ Ventana {int(window.width)}x{int(window.height)} leída de {object_name}")
+    return VENTANA_LEIDA
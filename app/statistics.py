@@ -1,12 +1,11 @@
 import os
 
 import geopandas as gpd
-import numpy as np
 import pandas as pd
-import rasterio
-from rasterio.mask import mask
 from shapely.geometry import shape
 
+from app.zonal import zonal_statistics
+
 
 def calculate_statistics_in_polygon(gdf_parcela, image_paths, polygon_id, indice):
     """
@@ -40,44 +39,44 @@ def calculate_statistics_in_polygon(gdf_parcela, image_paths, polygon_id, indice
         stats = {polygon_id: {}}
         data_for_csv = []
 
-        for image_path in valid_files:
+        if gdf_parcela.is_empty.any():
+            print(f"Parcel geometry is empty for polygon {polygon_id}.")
+            return stats
+
+        # Todas las fechas de una vez: la máscara se rasteriza una vez por rejilla.
+        resultados = zonal_statistics(gdf_parcela, valid_files)
+
+        for image_path, resultado in zip(valid_files, resultados):
             year_list = list(os.path.basename(image_path).split("_")[1])
             month = (os.path.basename(image_path).split("_")[2]).split(".")[0]
             original_filename = f"{month}{year_list[2]}{year_list[3]}"
-            with rasterio.open(image_path) as src:
-                gdf_parcela = gdf_parcela.to_crs(src.crs)
-                if gdf_parcela.is_empty.any():
-                    print(f"Parcel geometry is empty for image {image_path}.")
-                    continue
-                geometries = [gdf_parcela.geometry.iloc[0]]
-                out_image, out_transform = mask(src, geometries, crop=False)
-
-                # Calcular estadísticas solo si hay datos válidos
-                if np.isnan(out_image).all():
-                    print(
-                        f"No data found in masked area for image {image_path}. Skipping."
-                    )
-                    continue
-
-                mean_val = np.nanmean(out_image)
-                median_val = np.nanmedian(out_image)
-                std_dev_val = np.nanstd(out_image)
-
-                # Guardar datos en el diccionario de estadísticas por imagen
-                stats[polygon_id][f"{original_filename}_mean"] = mean_val
-                stats[polygon_id][f"{original_filename}_medi"] = median_val
-                stats[polygon_id][f"{original_filename}_std"] = std_dev_val
-
-                # Añadir datos al DataFrame de CSV
-                data_for_csv.append(
-                    {
-                        "polygon_id": polygon_id,
-                        "image_name": original_filename,
-                        "mean": mean_val,
-                        "median": median_val,
-                        "std_dev": std_dev_val,
-                    }
+
+            # Calcular estadísticas solo si hay datos válidos
+            if resultado["count"] == 0:
+                print(
+                    f"No data found in masked area for image {image_path}. Skipping."
                 )
+                continue
+
+            mean_val = resultado["mean"]
+            median_val = resultado["median"]
+            std_dev_val = resultado["std"]
+
+            # Guardar datos en el diccionario de estadísticas por imagen
+            stats[polygon_id][f"{original_filename}_mean"] = mean_val
+            stats[polygon_id][f"{original_filename}_medi"] = median_val
+            stats[polygon_id][f"{original_filename}_std"] = std_dev_val
+
+            # Añadir datos al DataFrame de CSV
+            data_for_csv.append(
+                {
+                    "polygon_id": polygon_id,
+                    "image_name": original_filename,
+                    "mean": mean_val,
+                    "median": median_val,
+                    "std_dev": std_dev_val,
+                }
+            )
 
         # Convertir a DataFrame para crear el CSV
         csv_df = pd.DataFrame(data_for_csv)
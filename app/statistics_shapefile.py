@@ -1,12 +1,25 @@
 import os
 
 import geopandas as gpd
-import numpy as np
 import pandas as pd
-import rasterio
-from rasterio.mask import mask
 from shapely.geometry import shape
 
+from app.zonal import zonal_statistics
+from app.zonal_pool import zonal_statistics_pool
+
+
+def _nombre_imagen(image_path):
+    # "NDVI_2023_11_x.tif" -> "1123": mes y año con dos cifras.
+    year_list = list(os.path.basename(image_path).split("_")[1])
+    month = (os.path.basename(image_path).split("_")[2]).split(".")[0]
+    return f"{month}{year_list[2]}{year_list[3]}".replace(" ", "")
+
+
+def _guardar(stats_poligono, original_filename, resultado):
+    stats_poligono[f"{original_filename}_mean"] = resultado["mean"]
+    stats_poligono[f"{original_filename}_medi"] = resultado["median"]
+    stats_poligono[f"{original_filename}_std"] = resultado["std"]
+
 
 def calculate_statistics_in_polygon(gdf_parcela, image_paths, polygon_id, indice):
     """
@@ -40,37 +53,33 @@ def calculate_statistics_in_polygon(gdf_parcela, image_paths, polygon_id, indice
         stats = {polygon_id: {}}
         data_for_csv = []
 
-        for image_path in valid_files:
-            year_list = list(os.path.basename(image_path).split("_")[1])
-            month = (os.path.basename(image_path).split("_")[2]).split(".")[0]
-            original_filename = f"{month}{year_list[2]}{year_list[3]}".replace(" ", "")
-            with rasterio.open(image_path) as src:
-                gdf_parcela = gdf_parcela.to_crs(src.crs)
-                if gdf_parcela.is_empty.any():
-                    print(f"Parcel geometry is empty for image {image_path}.")
-                    continue
-                geometries = [gdf_parcela.geometry.iloc[0]]
-                out_image, out_transform = mask(src, geometries, crop=False)
-
-                mean_val = np.nanmean(out_image)
-                median_val = np.nanmedian(out_image)
-                std_dev_val = np.nanstd(out_image)
-
-                # Guardar datos en el diccionario de estadísticas por imagen
-                stats[polygon_id][f"{original_filename}_mean"] = mean_val
-                stats[polygon_id][f"{original_filename}_medi"] = median_val
-                stats[polygon_id][f"{original_filename}_std"] = std_dev_val
-
-                # Añadir datos al DataFrame de CSV
-                data_for_csv.append(
-                    {
-                        "polygon_id": polygon_id,
-                        "image_name": original_filename,
-                        "mean": mean_val,
-                        "median": median_val,
-                        "std_dev": std_dev_val,
-                    }
-                )
+        if gdf_parcela.is_empty.any():
+            print(f"Parcel geometry is empty for polygon {polygon_id}.")
+            return stats
+
+        # Todas las fechas de una vez: la máscara se rasteriza una vez por rejilla.
+        resultados = zonal_statistics(gdf_parcela, valid_files)
+
+        for image_path, resultado in zip(valid_files, resultados):
+            original_filename = _nombre_imagen(image_path)
+
+            mean_val = resultado["mean"]
+            median_val = resultado["median"]
+            std_dev_val = resultado["std"]
+
+            # Guardar datos en el diccionario de estadísticas por imagen
+            _guardar(stats[polygon_id], original_filename, resultado)
+
+            # Añadir datos al DataFrame de CSV
+            data_for_csv.append(
+                {
+                    "polygon_id": polygon_id,
+                    "image_name": original_filename,
+                    "mean": mean_val,
+                    "median": median_val,
+                    "std_dev": std_dev_val,
+                }
+            )
 
         # Convertir a DataFrame para crear el CSV
         csv_df = pd.DataFrame(data_for_csv)
@@ -82,3 +91,46 @@ def calculate_statistics_in_polygon(gdf_parcela, image_paths, polygon_id, indice
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         raise
+
+
+def calculate_statistics_by_index(gdf, image_paths, polygon_ids, indices):
+    """
+    Calculates the statistics of every polygon of a shapefile for every index at
+    once, with the same output as calling ``calculate_statistics_in_polygon``
+    for each polygon and index.
+
+    The work is split among the processes of the statistics pool: one task per
+    raster with every polygon in labels mode, or groups of polygons otherwise
+    (see ``app.zonal_pool``).
+
+    Args:
+        gdf (GeoDataFrame): Polygons to process.
+        image_paths (list of str): List of paths to raster files.
+        polygon_ids (list): Identifier of each polygon, in the order of ``gdf``.
+        indices (list of str): Indexes whose rasters are used.
+
+    Returns:
+        dict: For each index, one dictionary {polygon_id: statistics} per polygon.
+    """
+    valid_files = {}
+    for indice in indices:
+        valid_files[indice] = [f for f in image_paths if f.endswith(".tif") and (indice in f)]
+        if not valid_files[indice]:
+            print("No files found with the .tif format.")
+            raise FileNotFoundError("No files found with the .tif format.")
+
+    por_indice = zonal_statistics_pool(gdf, valid_files)
+
+    stats = {}
+    for indice, por_poligono in por_indice.items():
+        stats[indice] = []
+        for polygon_id, geometria, resultados in zip(polygon_ids, gdf.geometry, por_poligono):
+            stats_poligono = {}
+            if geometria is None or geometria.is_empty:
+                print(f"Parcel geometry is empty for polygon {polygon_id}.")
+            else:
+                for image_path, resultado in zip(valid_files[indice], resultados):
+                    _guardar(stats_poligono, _nombre_imagen(image_path), resultado)
+            stats[indice].append({polygon_id: stats_poligono})
+    return stats
+
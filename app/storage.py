@@ -0,0 +1,275 @@
+import contextvars
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+from dotenv import load_dotenv
+from minio import Minio
+from minio.error import S3Error
+
+from app.local_store import LocalObjectStore
+
+
+load_dotenv()
+
+MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
+MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
+MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
+# Si se define, los buckets se sirven desde este directorio en lugar de MinIO.
+MINIO_LOCAL_ROOT = os.getenv("MINIO_LOCAL_ROOT")
+
+# Límite global de transferencias simultáneas contra MinIO en todo el proceso.
+TRANSFER_MAX_WORKERS = int(os.getenv("TRANSFER_MAX_WORKERS", "16"))
+# Máximo de transferencias en vuelo de una misma petición.
+TRANSFER_JOB_MAX_IN_FLIGHT = int(os.getenv("TRANSFER_JOB_MAX_IN_FLIGHT", "8"))
+MINIO_POOL_MAXSIZE = int(os.getenv("MINIO_POOL_MAXSIZE", str(TRANSFER_MAX_WORKERS + 4)))
+TRANSFER_MAX_RETRIES = int(os.getenv("TRANSFER_MAX_RETRIES", "5"))
+TRANSFER_BACKOFF_SECONDS = float(os.getenv("TRANSFER_BACKOFF_SECONDS", "0.5"))
+# Comprobar el MD5 contra el ETag cuando éste no es de una subida multiparte.
+TRANSFER_VERIFY_MD5 = os.getenv("TRANSFER_VERIFY_MD5", "1") == "1"
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+# Errores de S3 que no se arreglan reintentando.
+_ERRORES_DEFINITIVOS = {
+    "NoSuchKey",
+    "NoSuchBucket",
+    "AccessDenied",
+    "InvalidAccessKeyId",
+    "SignatureDoesNotMatch",
+}
+
+_lock = threading.Lock()
+_client = None
+_executor = None
+_current_job = contextvars.ContextVar("transfer_job", default=None)
+
+
+class TransferError(Exception):
+    """Una descarga ha fallado definitivamente (tras agotar los reintentos)."""
+
+
+class TransferReport:
+    """
+    Registro, por trabajo, de los objetos que han necesitado reintentos y de los
+    que han fallado definitivamente.
+    """
+
+    def __init__(self):
+        self.retried = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def record_retry(self, object_name):
+        with self._lock:
+            self.retried[object_name] = self.retried.get(object_name, 0) + 1
+
+    def record_failure(self, object_name, error):
+        with self._lock:
+            self.failed[object_name] = str(error)
+
+    def summary(self):
+        with self._lock:
+            return (
+                f"{len(self.retried)} objetos reintentados "
+                f"({sum(self.retried.values())} reintentos), {len(self.failed)} fallidos"
+            )
+
+
+def get_minio_client():
+    """
+    Devuelve el cliente de MinIO compartido por todo el proceso. Usa un
+    ``urllib3.PoolManager`` dimensionado para el pool de transferencias, de modo
+    que las conexiones se reutilizan entre peticiones.
+
+    Con ``MINIO_LOCAL_ROOT`` definido devuelve un ``LocalObjectStore`` sobre ese
+    directorio, con la misma interfaz.
+    """
+    global _client
+    with _lock:
+        if _client is None and MINIO_LOCAL_ROOT:
+            _client = LocalObjectStore(MINIO_LOCAL_ROOT)
+        if _client is None:
+            http_client = urllib3.PoolManager(
+                maxsize=MINIO_POOL_MAXSIZE,
+                block=True,
+                timeout=urllib3.Timeout(connect=10, read=300),
+                retries=urllib3.Retry(
+                    total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+                ),
+            )
+            _client = Minio(
+                endpoint=MINIO_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client,
+            )
+        return _client
+
+
+def dataset_path(bucket_name, object_name):
+    """
+    Ruta con la que GDAL abre un objeto del bucket: ``/vsis3/`` contra MinIO o
+    el fichero en disco con el almacén local.
+    """
+    if MINIO_LOCAL_ROOT:
+        return LocalObjectStore(MINIO_LOCAL_ROOT).local_path(bucket_name, object_name)
+    return f"/vsis3/{bucket_name}/{object_name}"
+
+
+def get_transfer_executor():
+    """
+    Devuelve el pool de hilos de transferencia compartido por todo el proceso.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=TRANSFER_MAX_WORKERS, thread_name_prefix="transfer"
+            )
+        return _executor
+
+
+class TransferJob:
+    """
+    Cuota de una petición sobre el pool de transferencias compartido.
+
+    Cada trabajo puede tener en vuelo como mucho su parte justa del pool
+    (``TRANSFER_MAX_WORKERS`` entre los trabajos activos, sin pasar de
+    ``max_in_flight``); ``submit`` bloquea hasta que haya hueco. Así un usuario con
+    un rango de varios años no acapara las conexiones de los demás.
+
+    Se usa como gestor de contexto para registrarse como trabajo activo.
+    """
+
+    _active = 0
+    _active_lock = threading.Lock()
+
+    def __init__(self, max_in_flight=TRANSFER_JOB_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.report = TransferReport()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with TransferJob._active_lock:
+            TransferJob._active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with TransferJob._active_lock:
+            TransferJob._active -= 1
+        if self.report.retried or self.report.failed:
+            print(f"⚠️ Informe de transferencias: {self.report.summary()}")
+            for object_name, error in self.report.failed.items():
+                print(f"❌ {object_name}: {error}")
+        return False
+
+    def share(self):
+        with TransferJob._active_lock:
+            activos = max(1, TransferJob._active)
+        return max(1, min(self.max_in_flight, TRANSFER_MAX_WORKERS // activos))
+
+    def submit(self, fn, *args, **kwargs):
+        with self._cond:
+            # La parte justa cambia cuando entran o salen otros trabajos.
+            while self._in_flight >= self.share():
+                self._cond.wait(timeout=1.0)
+            self._in_flight += 1
+        # Las descargas registran sus reintentos y fallos en el informe de este trabajo.
+        contexto = contextvars.copy_context()
+        contexto.run(_current_job.set, self)
+        try:
+            future = get_transfer_executor().submit(contexto.run, fn, *args, **kwargs)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+
+def _es_reintentable(error):
+    if isinstance(error, S3Error):
+        return error.code not in _ERRORES_DEFINITIVOS
+    return isinstance(error, (urllib3.exceptions.HTTPError, OSError, TransferError))
+
+
+def verificar_descarga(path, size=None, etag=None):
+    """
+    Comprueba el tamaño y, si el ETag es un MD5 simple, el checksum del fichero
+    descargado. Lanza ``TransferError`` si no coinciden.
+    """
+    tamano = os.path.getsize(path)
+    if size is not None and tamano != size:
+        raise TransferError(f"tamaño {tamano} distinto del esperado {size}")
+    etag = (etag or "").strip('"')
+    if TRANSFER_VERIFY_MD5 and re.fullmatch(r"[0-9a-f]{32}", etag):
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for bloque in iter(lambda: f.read(TRANSFER_CHUNK_SIZE), b""):
+                md5.update(bloque)
+        if md5.hexdigest() != etag:
+            raise TransferError(f"MD5 {md5.hexdigest()} distinto del ETag {etag}")
+
+
+def download_object(client, bucket_name, obj, file_path):
+    """
+    Descarga ``obj`` en ``file_path`` con reintentos y espera exponencial. Si una
+    transferencia se corta, el siguiente intento pide sólo los bytes que faltan
+    (``offset``). El fichero se verifica contra el tamaño y el ETag del objeto
+    antes de darlo por bueno.
+
+    Args:
+        client (Minio): Cliente de MinIO.
+        bucket_name (str): Bucket de origen.
+        obj: Objeto con ``object_name`` y, opcionalmente, ``size`` y ``etag``.
+        file_path (str): Fichero local de destino (se completa si ya existe).
+
+    Raises:
+        TransferError: Si la descarga no se completa tras ``TRANSFER_MAX_RETRIES`` reintentos.
+    """
+    job = _current_job.get()
+    size = getattr(obj, "size", None)
+    etag = getattr(obj, "etag", None)
+    intento = 0
+    while True:
+        try:
+            offset = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            if size is None or offset < size:
+                response = client.get_object(bucket_name, obj.object_name, offset=offset)
+                try:
+                    with open(file_path, "ab") as f:
+                        for bloque in response.stream(TRANSFER_CHUNK_SIZE):
+                            f.write(bloque)
+                finally:
+                    response.close()
+                    response.release_conn()
+            try:
+                verificar_descarga(file_path, size, etag)
+            except TransferError:
+                # Un fichero corrupto no se puede reanudar: se empieza de cero.
+                os.remove(file_path)
+                raise
+            return file_path
+        except Exception as e:
+            if not _es_reintentable(e) or intento >= TRANSFER_MAX_RETRIES:
+                if job is not None:
+                    job.report.record_failure(obj.object_name, e)
+                raise TransferError(f"{obj.object_name}: {e}") from e
+            intento += 1
+            if job is not None:
+                job.report.record_retry(obj.object_name)
+            espera = TRANSFER_BACKOFF_SECONDS * 2 ** (intento - 1)
+            espera += random.uniform(0, espera / 2)
+            print(f"⚠️ Reintento {intento} de {obj.object_name} en {espera:.1f}s: {e}")
+            time.sleep(espera)
@@ -0,0 +1,240 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from dotenv import load_dotenv
+
+from app.storage import download_object
+
+
+load_dotenv()
+
+TILE_CACHE_DIR = os.getenv(
+    "TILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tile_cache")
+)
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", str(20 * 1024**3)))
+
+
+def _link_or_copy(origen, destino):
+    """
+    Enlaza (hard link) un fichero de la caché en la carpeta de trabajo; si el
+    sistema de ficheros no lo permite, lo copia.
+    """
+    try:
+        os.link(origen, destino)
+    except OSError:
+        shutil.copyfile(origen, destino)
+
+
+class SingleFlight:
+    """
+    Agrupa las llamadas concurrentes con la misma clave: la primera ejecuta la
+    función y las demás esperan a que termine y comparten su resultado (o su
+    excepción).
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._calls[key] = call
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result()
+
+        try:
+            resultado = fn(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(resultado)
+            return resultado
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class TileCache:
+    """
+    Caché en disco, compartida por todo el proceso, de los objetos descargados de MinIO.
+
+    Cada entrada se direcciona por (bucket, nombre de objeto, ETag), de modo que un
+    objeto reescrito en el bucket nunca se sirve obsoleto. El tamaño total está
+    limitado por un presupuesto de bytes con expulsión LRU, y las escrituras son
+    atómicas (fichero temporal + ``os.replace``) para que otro hilo o proceso nunca
+    lea una entrada a medio escribir.
+    """
+
+    nombre = "caché de teselas"
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._in_flight = SingleFlight()
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Reconstruye el índice LRU a partir de los ficheros ya presentes en disco,
+        ordenados por fecha de último uso.
+        """
+        entradas = []
+        for carpeta, _, ficheros in os.walk(self.root):
+            for nombre in ficheros:
+                if nombre.endswith(".part"):
+                    continue
+                ruta = os.path.join(carpeta, nombre)
+                try:
+                    info = os.stat(ruta)
+                except OSError:
+                    continue
+                entradas.append((info.st_mtime, os.path.splitext(nombre)[0], info.st_size))
+        for _, key, size in sorted(entradas):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def key(bucket_name, object_name, etag):
+        etag = (etag or "").strip('"')
+        return hashlib.sha256(f"{bucket_name}/{object_name}/{etag}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.tif")
+
+    def contains(self, bucket_name, object_name, etag):
+        """
+        Indica si el objeto está en caché, sin alterar contadores ni orden LRU.
+        """
+        key = self.key(bucket_name, object_name, etag)
+        with self._lock:
+            return key in self._entries and os.path.exists(self._path(key))
+
+    def get(self, key):
+        """
+        Devuelve la ruta de la entrada si está en caché (y la marca como usada), o None.
+        """
+        ruta = self._path(key)
+        with self._lock:
+            if key in self._entries and os.path.exists(ruta):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                try:
+                    os.utime(ruta)
+                except OSError:
+                    pass
+                return ruta
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, origen):
+        """
+        Publica atómicamente el fichero ``origen`` como entrada ``key`` y aplica
+        la expulsión LRU si se supera el presupuesto de bytes.
+        """
+        ruta = self._path(key)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        os.replace(origen, ruta)
+        size = os.path.getsize(ruta)
+        with self._lock:
+            previo = self._entries.pop(key, None)
+            if previo is not None:
+                self._total_bytes -= previo
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict(keep=key)
+        return ruta
+
+    def _evict(self, keep):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            print(f"♻️ Expulsada de la {self.nombre}: {key}")
+
+    def _download(self, client, bucket_name, obj, key):
+        ruta = self._path(key)
+        with self._lock:
+            if key in self._entries and os.path.exists(ruta):
+                return ruta
+        carpeta = os.path.dirname(ruta)
+        os.makedirs(carpeta, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=carpeta, suffix=".part")
+        os.close(fd)
+        try:
+            download_object(client, bucket_name, obj, tmp_path)
+            return self.put(key, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def warm(self, client, bucket_name, obj):
+        """
+        Garantiza que el objeto ``obj`` está en la caché, descargándolo si hace
+        falta, y devuelve la ruta de su entrada. Las peticiones concurrentes del
+        mismo objeto esperan a una única descarga.
+        """
+        key = self.key(bucket_name, obj.object_name, obj.etag)
+        ruta = self.get(key)
+        if ruta is None:
+            ruta = self._in_flight.do(key, self._download, client, bucket_name, obj, key)
+        return ruta
+
+    def fetch(self, client, bucket_name, obj, local_file_path):
+        """
+        Deja en ``local_file_path`` el objeto ``obj`` del bucket, sirviéndolo desde
+        la caché si está disponible y descargándolo (y cacheándolo) si no lo está.
+        """
+        _link_or_copy(self.warm(client, bucket_name, obj), local_file_path)
+        return local_file_path
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self._in_flight.shared,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    """
+    Devuelve la instancia de ``TileCache`` compartida por todo el proceso.
+    """
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            _tile_cache = TileCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES)
+        return _tile_cache
@@ -0,0 +1,489 @@
+import os
+import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+import shapely
+from dotenv import load_dotenv
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window, rasterize
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
+from shapely import STRtree
+
+from app.mosaic import MERGE_MEM_LIMIT_MB, filas_por_franja
+from app.raster_io import en_memoria
+
+
+load_dotenv()
+
+# "labels": las estadísticas de un shapefile se calculan para todas las parcelas
+# a la vez con un raster de etiquetas. "polygon": parcela a parcela.
+ZONAL_MODE = os.getenv("ZONAL_MODE", "labels")
+# Percentiles que ``zonal_statistics`` calcula además de la mediana.
+ZONAL_PERCENTILES = [
+    float(p) for p in os.getenv("ZONAL_PERCENTILES", "10,90").split(",") if p.strip()
+]
+# "exact": mediana y percentiles exactos, con todos los píxeles de la parcela en
+# memoria. "histogram": aproximados con un histograma de ZONAL_HISTOGRAM_BINS
+# clases en ZONAL_HISTOGRAM_RANGE acumulado por franjas, con memoria constante
+# y un error de como mucho una clase para los valores dentro del rango.
+ZONAL_QUANTILES = os.getenv("ZONAL_QUANTILES", "exact")
+ZONAL_HISTOGRAM_BINS = int(os.getenv("ZONAL_HISTOGRAM_BINS", "4096"))
+ZONAL_HISTOGRAM_RANGE = tuple(
+    float(v) for v in os.getenv("ZONAL_HISTOGRAM_RANGE", "-1,1").split(",")
+)
+
+
+# Datasets abiertos que conserva cada worker del pool de estadísticas.
+_MAX_ABIERTOS = 64
+_reutilizar = False
+_abiertos = OrderedDict()
+
+
+def reutilizar_datasets():
+    """
+    Hace que este proceso conserve abiertos los rasters que lee, para no
+    reabrirlos en cada tarea. Es el inicializador de los workers del pool de
+    estadísticas: un proceso sin hilos, así que los datasets no se comparten.
+    """
+    global _reutilizar
+    _reutilizar = True
+
+
+@contextmanager
+def _abrir(path):
+    if not _reutilizar or en_memoria(path):
+        with rasterio.open(path) as src:
+            yield src
+        return
+    # Con la fecha y el tamaño en la clave, un fichero reescrito con el mismo
+    # nombre (los temporales se reutilizan) se vuelve a abrir.
+    estado = os.stat(path)
+    clave = (path, estado.st_mtime_ns, estado.st_size)
+    src = _abiertos.pop(clave, None)
+    if src is None:
+        src = rasterio.open(path)
+    _abiertos[clave] = src
+    while len(_abiertos) > _MAX_ABIERTOS:
+        _abiertos.popitem(last=False)[1].close()
+    yield src
+
+
+def zonal_labels_enabled():
+    return ZONAL_MODE == "labels"
+
+
+def _rejilla(src):
+    return (src.crs.to_wkt() if src.crs else None, tuple(src.transform), src.width, src.height, src.count)
+
+
+def _ventana_parcela(src, gdf_parcela):
+    """
+    Máscara de la parcela (True fuera) y ventana que ocupa en la rejilla de
+    ``src``, o (None, None) si la parcela está vacía o fuera del raster.
+    """
+    geometria = gdf_parcela.to_crs(src.crs).geometry.iloc[0] if src.crs else gdf_parcela.geometry.iloc[0]
+    if geometria is None or geometria.is_empty:
+        return None, None
+    try:
+        fuera, _, ventana = raster_geometry_mask(src, [geometria], crop=True)
+    except ValueError:
+        return None, None
+    return fuera, ventana
+
+
+def zonal_stack(gdf_parcela, image_paths):
+    """
+    Lee de cada raster sólo la ventana de la parcela y se queda con los píxeles
+    que caen dentro, con NaN en los que no tienen dato. La máscara de la parcela
+    se rasteriza una vez por rejilla (CRS, transformación, tamaño), no una vez
+    por raster.
+
+    Args:
+        gdf_parcela (GeoDataFrame): GeoDataFrame con la geometría de la parcela.
+        image_paths (list of str): Rasters, uno por paso de tiempo.
+
+    Returns:
+        list: Por cada raster, en el orden de ``image_paths``, un array 1D con
+        los valores de la parcela (todas las bandas), vacío si no la toca.
+    """
+    mascaras = {}
+    valores = []
+    for image_path in image_paths:
+        with _abrir(image_path) as src:
+            rejilla = _rejilla(src)
+            if rejilla not in mascaras:
+                mascaras[rejilla] = _ventana_parcela(src, gdf_parcela)
+            fuera, ventana = mascaras[rejilla]
+            if ventana is None:
+                valores.append(np.empty(0))
+                continue
+            datos = src.read(window=ventana, out_shape=(src.count,) + fuera.shape)
+            datos = datos[:, ~fuera].astype(np.float64).ravel()
+            if src.nodata is not None and not np.isnan(src.nodata):
+                datos[datos == src.nodata] = np.nan
+            valores.append(datos)
+    return valores
+
+
+def _clases(valores, lo, hi, bins):
+    """
+    Clase de cada valor en ``bins`` clases iguales de [lo, hi); los valores de
+    fuera caen en la primera o la última.
+    """
+    clases = ((valores - lo) * (bins / (hi - lo))).astype(np.int64)
+    np.clip(clases, 0, bins - 1, out=clases)
+    return clases
+
+
+def _percentiles_histograma(cuentas, count, qs, lo, hi):
+    """
+    Cuantiles ``qs`` de cada fila de ``cuentas`` (histogramas de clases iguales
+    en [lo, hi)), interpolados dentro de su clase. Las filas sin valores dan NaN.
+    """
+    bins = cuentas.shape[1]
+    ancho = (hi - lo) / bins
+    filas = np.flatnonzero(count > 0)
+    acumulado = np.cumsum(cuentas[filas], axis=1)
+    resultado = np.full((len(qs), len(count)), np.nan)
+    for i, q in enumerate(qs):
+        rango = q / 100 * count[filas]
+        # Como ``np.searchsorted(..., side="left")`` en cada fila.
+        clase = np.minimum((acumulado < rango[:, None]).sum(axis=1), bins - 1)
+        en_clase = cuentas[filas, clase]
+        antes = acumulado[np.arange(len(filas)), clase] - en_clase
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraccion = np.where(en_clase > 0, (rango - antes) / en_clase, 0.5)
+        resultado[i, filas] = lo + (clase + fraccion) * ancho
+    return resultado
+
+
+class Histograma:
+    """
+    Resumen acumulable de una muestra: recuento, suma, suma de cuadrados e
+    histograma de clases fijas. Dos histogramas con las mismas clases se unen
+    sumándolos, así que se pueden acumular por bloques o por procesos.
+
+    Los cuantiles se interpolan dentro de su clase, con un error de como mucho
+    una clase (``(hi - lo) / bins``); los valores fuera de ``rango`` cuentan en
+    la primera o la última clase.
+    """
+
+    def __init__(self, bins=None, rango=None):
+        self.bins = bins or ZONAL_HISTOGRAM_BINS
+        self.lo, self.hi = rango or ZONAL_HISTOGRAM_RANGE
+        self.cuentas = np.zeros(self.bins, dtype=np.int64)
+        self.count = 0
+        self.suma = 0.0
+        self.cuadrados = 0.0
+
+    def add(self, valores):
+        valores = valores[~np.isnan(valores)]
+        if not len(valores):
+            return
+        self.count += len(valores)
+        self.suma += valores.sum()
+        self.cuadrados += np.dot(valores, valores)
+        clases = _clases(valores, self.lo, self.hi, self.bins)
+        self.cuentas += np.bincount(clases, minlength=self.bins)
+
+    def merge(self, otro):
+        self.cuentas += otro.cuentas
+        self.count += otro.count
+        self.suma += otro.suma
+        self.cuadrados += otro.cuadrados
+        return self
+
+    def percentile(self, q):
+        cuantil = _percentiles_histograma(
+            self.cuentas[np.newaxis], np.array([self.count]), [q], self.lo, self.hi
+        )
+        return cuantil[0, 0]
+
+    def estadisticas(self, percentiles):
+        if self.count:
+            mean = self.suma / self.count
+            std = np.sqrt(max(self.cuadrados / self.count - mean * mean, 0))
+        else:
+            mean = std = np.nan
+        stats = {
+            "count": int(self.count),
+            "mean": mean,
+            "median": self.percentile(50),
+            "std": std,
+        }
+        for p in percentiles:
+            stats[f"p{p:g}"] = self.percentile(p)
+        return stats
+
+
+def _histograma_parcela(src, geometria, mem_limit_mb=MERGE_MEM_LIMIT_MB):
+    """
+    Histograma de los valores de ``src`` dentro de ``geometria`` (en su CRS),
+    leyendo la ventana de la parcela por franjas horizontales: la memoria no
+    depende del tamaño de la parcela.
+    """
+    histograma = Histograma()
+    if geometria is None or geometria.is_empty:
+        return histograma
+    try:
+        ventana = geometry_window(src, [geometria])
+    except WindowError:
+        return histograma
+    ancho = int(ventana.width)
+    filas = filas_por_franja(ancho, src.count, "float64", mem_limit_mb)
+    for fila in range(0, int(ventana.height), filas):
+        franja = Window(ventana.col_off, ventana.row_off + fila, ancho, min(filas, int(ventana.height) - fila))
+        forma = (int(franja.height), ancho)
+        fuera = geometry_mask([geometria], out_shape=forma, transform=src.window_transform(franja))
+        datos = src.read(window=franja, out_shape=(src.count,) + forma).astype(np.float64)
+        if src.nodata is not None and not np.isnan(src.nodata):
+            datos[datos == src.nodata] = np.nan
+        histograma.add(datos[:, ~fuera].ravel())
+    return histograma
+
+
+def zonal_statistics_histogram(gdf_parcela, image_paths, percentiles=None):
+    """
+    Como ``zonal_statistics``, pero con la mediana y los percentiles
+    aproximados de un ``Histograma`` acumulado por franjas: para parcelas muy
+    grandes, con memoria constante y cualquier percentil sin otra pasada.
+    """
+    if percentiles is None:
+        percentiles = ZONAL_PERCENTILES
+    geometrias_crs = {}
+    resultados = []
+    for image_path in image_paths:
+        with _abrir(image_path) as src:
+            clave_crs = src.crs.to_wkt() if src.crs else None
+            if clave_crs not in geometrias_crs:
+                geometrias_crs[clave_crs] = (
+                    gdf_parcela.to_crs(src.crs) if src.crs else gdf_parcela
+                ).geometry.iloc[0]
+            histograma = _histograma_parcela(src, geometrias_crs[clave_crs])
+        resultados.append(histograma.estadisticas(percentiles))
+    return resultados
+
+
+def zonal_statistics(gdf_parcela, image_paths, percentiles=None):
+    """
+    Estadísticas de la parcela en cada raster de una serie temporal, calculadas
+    de una vez sobre la pila (tiempo, píxeles) de ``zonal_stack``. Con
+    ``ZONAL_QUANTILES=histogram`` delega en ``zonal_statistics_histogram``.
+
+    Args:
+        gdf_parcela (GeoDataFrame): GeoDataFrame con la geometría de la parcela.
+        image_paths (list of str): Rasters, uno por paso de tiempo.
+        percentiles (list of float, optional): Percentiles además de la mediana;
+            por defecto ``ZONAL_PERCENTILES``.
+
+    Returns:
+        list of dict: Por cada raster, en el orden de ``image_paths``: ``count``
+        (píxeles válidos), ``mean``, ``median``, ``std`` y ``p<n>`` por cada
+        percentil. Sin píxeles válidos, ``count`` es 0 y el resto NaN.
+    """
+    if ZONAL_QUANTILES == "histogram":
+        return zonal_statistics_histogram(gdf_parcela, image_paths, percentiles)
+    if percentiles is None:
+        percentiles = ZONAL_PERCENTILES
+    valores = zonal_stack(gdf_parcela, image_paths)
+    if not valores:
+        return []
+
+    # Las series se rellenan con NaN hasta la más larga para reducirlas juntas.
+    ancho = max(len(v) for v in valores)
+    pila = np.full((len(valores), max(ancho, 1)), np.nan)
+    for t, v in enumerate(valores):
+        pila[t, : len(v)] = v
+
+    with warnings.catch_warnings():
+        # Los pasos sin datos dan NaN, que es lo que se quiere.
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        count = np.sum(~np.isnan(pila), axis=1)
+        mean = np.nanmean(pila, axis=1)
+        std = np.nanstd(pila, axis=1)
+        cuantiles = np.nanpercentile(pila, [50, *percentiles], axis=1)
+
+    resultados = []
+    for t in range(len(valores)):
+        stats = {
+            "count": int(count[t]),
+            "mean": mean[t],
+            "median": cuantiles[0, t],
+            "std": std[t],
+        }
+        for i, p in enumerate(percentiles, start=1):
+            stats[f"p{p:g}"] = cuantiles[i, t]
+        resultados.append(stats)
+    return resultados
+
+
+def _percentiles_por_etiqueta(etiquetas, valores, count, qs):
+    """
+    Percentiles (interpolación lineal, como ``np.nanpercentile``) de los valores
+    de cada etiqueta, con una sola ordenación de todos los píxeles.
+    """
+    orden = np.lexsort((valores, etiquetas))
+    ordenados = valores[orden]
+    inicio = np.concatenate(([0], np.cumsum(count)[:-1]))
+    hay = count > 0
+    resultado = np.full((len(qs), len(count)), np.nan)
+    for i, q in enumerate(qs):
+        pos = q / 100 * (count[hay] - 1)
+        bajo = np.floor(pos).astype(np.int64)
+        alto = np.ceil(pos).astype(np.int64)
+        v_bajo = ordenados[inicio[hay] + bajo]
+        v_alto = ordenados[inicio[hay] + alto]
+        resultado[i, hay] = v_bajo + (v_alto - v_bajo) * (pos - bajo)
+    return resultado
+
+
+def _parcelas_solapadas(geometrias):
+    """
+    Índices de las geometrías que comparten superficie con alguna otra. Las que
+    sólo se tocan por el borde no comparten píxeles al rasterizarse.
+    """
+    validas = [
+        i for i, geometria in enumerate(geometrias)
+        if geometria is not None and not geometria.is_empty
+    ]
+    formas = np.array([geometrias[i] for i in validas], dtype=object)
+    if len(formas) < 2:
+        return set()
+    a, b = STRtree(formas).query(formas, predicate="intersects")
+    distintas = a < b
+    a, b = a[distintas], b[distintas]
+    con_superficie = shapely.area(shapely.intersection(formas[a], formas[b])) > 0
+    return {validas[i] for i in np.concatenate((a[con_superficie], b[con_superficie]))}
+
+
+def _estadisticas_etiquetas(src, geometrias, qs, mem_limit_mb=MERGE_MEM_LIMIT_MB):
+    """
+    Recuento, suma, suma de cuadrados y cuantiles ``qs`` de los valores de
+    ``src`` dentro de cada geometría (etiquetas 1..n, la 0 es el exterior). La
+    ventana que cubre las geometrías se recorre por franjas: en cada una se
+    rasterizan las etiquetas, se acumulan los ``np.bincount`` y se guardan sólo
+    los píxeles de alguna parcela para ordenarlos al final. Con
+    ``ZONAL_QUANTILES=histogram`` no se guardan los píxeles: se acumula un
+    histograma por etiqueta (``bincount`` de ``etiqueta * bins + clase``) y los
+    cuantiles se aproximan como en ``Histograma``. Las franjas sin parcelas no
+    se leen. Las geometrías no deben compartir píxeles.
+    """
+    n = len(geometrias)
+    count = np.zeros(n + 1, dtype=np.int64)
+    suma = np.zeros(n + 1)
+    cuadrados = np.zeros(n + 1)
+    formas = [
+        (geometria, i)
+        for i, geometria in enumerate(geometrias, start=1)
+        if geometria is not None and not geometria.is_empty
+    ]
+    if not formas:
+        return count, suma, cuadrados, np.full((len(qs), n + 1), np.nan)
+    try:
+        ventana = geometry_window(src, [geometria for geometria, _ in formas])
+    except WindowError:
+        return count, suma, cuadrados, np.full((len(qs), n + 1), np.nan)
+
+    ancho, alto = int(ventana.width), int(ventana.height)
+    filas = filas_por_franja(ancho, src.count, "float64", mem_limit_mb)
+    histograma = ZONAL_QUANTILES == "histogram"
+    if histograma:
+        bins, (lo, hi) = ZONAL_HISTOGRAM_BINS, ZONAL_HISTOGRAM_RANGE
+        cuentas = np.zeros((n + 1) * bins, dtype=np.int64)
+    etiquetas, valores = [], []
+    for fila in range(0, alto, filas):
+        franja = Window(ventana.col_off, ventana.row_off + fila, ancho, min(filas, alto - fila))
+        forma = (int(franja.height), ancho)
+        etiquetas_franja = rasterize(
+            formas, out_shape=forma, transform=src.window_transform(franja), fill=0, dtype="int32"
+        )
+        if not etiquetas_franja.any():
+            continue
+        datos = src.read(window=franja, out_shape=(src.count,) + forma).astype(np.float64)
+        if src.nodata is not None and not np.isnan(src.nodata):
+            datos[datos == src.nodata] = np.nan
+        etiqueta = np.broadcast_to(etiquetas_franja, datos.shape).ravel()
+        valor = datos.ravel()
+        validos = (etiqueta > 0) & ~np.isnan(valor)
+        etiqueta, valor = etiqueta[validos], valor[validos]
+        count += np.bincount(etiqueta, minlength=n + 1)
+        suma += np.bincount(etiqueta, weights=valor, minlength=n + 1)
+        cuadrados += np.bincount(etiqueta, weights=valor * valor, minlength=n + 1)
+        if histograma:
+            clases = etiqueta * bins + _clases(valor, lo, hi, bins)
+            cuentas += np.bincount(clases, minlength=(n + 1) * bins)
+            continue
+        etiquetas.append(etiqueta)
+        valores.append(valor)
+
+    if histograma:
+        cuantiles = _percentiles_histograma(cuentas.reshape(n + 1, bins), count, qs, lo, hi)
+        return count, suma, cuadrados, cuantiles
+    if not etiquetas:
+        return count, suma, cuadrados, np.full((len(qs), n + 1), np.nan)
+    cuantiles = _percentiles_por_etiqueta(np.concatenate(etiquetas), np.concatenate(valores), count, qs)
+    return count, suma, cuadrados, cuantiles
+
+
+def zonal_statistics_labels(gdf, image_paths, percentiles=None):
+    """
+    Estadísticas de todas las parcelas de ``gdf`` en cada raster con un solo
+    recorrido de los píxeles por raster: las parcelas se rasterizan juntas en
+    un raster de etiquetas, por franjas de como mucho ``MERGE_MEM_LIMIT_MB``, y
+    el recuento, la suma y la suma de cuadrados de cada una salen de
+    ``np.bincount``; la mediana y los percentiles, de una única ordenación de
+    los píxeles por etiqueta y valor. Las parcelas que se solapan con otras no
+    caben en un raster de etiquetas y se calculan con ``zonal_statistics``.
+
+    Args:
+        gdf (GeoDataFrame): Parcelas.
+        image_paths (list of str): Rasters, uno por paso de tiempo.
+        percentiles (list of float, optional): Percentiles además de la mediana;
+            por defecto ``ZONAL_PERCENTILES``.
+
+    Returns:
+        list: Por cada parcela, en el orden de ``gdf``, la lista de estadísticas
+        por raster en el mismo formato que ``zonal_statistics``.
+    """
+    if percentiles is None:
+        percentiles = ZONAL_PERCENTILES
+    n = len(gdf)
+    solapadas = _parcelas_solapadas(list(gdf.geometry))
+    geometrias_crs = {}
+    resultados = [[] for _ in range(n)]
+
+    for image_path in image_paths:
+        with _abrir(image_path) as src:
+            clave_crs = src.crs.to_wkt() if src.crs else None
+            if clave_crs not in geometrias_crs:
+                geometrias = list(gdf.to_crs(src.crs).geometry) if src.crs else list(gdf.geometry)
+                geometrias_crs[clave_crs] = [
+                    None if i in solapadas else geometria for i, geometria in enumerate(geometrias)
+                ]
+            count, suma, cuadrados, cuantiles = _estadisticas_etiquetas(
+                src, geometrias_crs[clave_crs], [50, *percentiles]
+            )
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = suma / count
+            std = np.sqrt(np.maximum(cuadrados / count - mean * mean, 0))
+        for i in range(n):
+            stats = {
+                "count": int(count[i + 1]),
+                "mean": mean[i + 1],
+                "median": cuantiles[0, i + 1],
+                "std": std[i + 1],
+            }
+            for j, p in enumerate(percentiles, start=1):
+                stats[f"p{p:g}"] = cuantiles[j, i + 1]
+            resultados[i].append(stats)
+
+    if solapadas:
+        print(f"⚠️ {len(solapadas)} parcelas se solapan con otras; se calculan parcela a parcela.")
+        for i in sorted(solapadas):
+            resultados[i] = zonal_statistics(gdf.iloc[[i]], image_paths, percentiles)
+    return resultados
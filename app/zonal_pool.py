@@ -0,0 +1,140 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from dotenv import load_dotenv
+
+from app.raster_io import en_memoria
+from app.zonal import (
+    reutilizar_datasets,
+    zonal_labels_enabled,
+    zonal_statistics,
+    zonal_statistics_labels,
+)
+
+
+load_dotenv()
+
+# Procesos entre los que se reparten las estadísticas; 1 calcula en este proceso.
+# Por defecto la mitad de las CPU: el pool de fusión puede estar ocupando el resto.
+ZONAL_MAX_WORKERS = int(
+    os.getenv("ZONAL_MAX_WORKERS", str(max(1, (os.cpu_count() or 1) // 2)))
+)
+# Fragmentos por worker en el modo parcela a parcela: más de uno reparte mejor
+# parcelas de coste desigual.
+_FRAGMENTOS_POR_WORKER = 4
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_zonal_executor():
+    """
+    Devuelve el pool de estadísticas compartido por todo el proceso, creado con
+    ``spawn`` como el de fusión. Cada worker conserva abiertos los rasters que
+    lee entre tareas.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=ZONAL_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=reutilizar_datasets,
+            )
+        return _executor
+
+
+def _descartar_executor(executor):
+    """
+    Olvida ``executor`` si sigue siendo el pool compartido, para que el siguiente
+    ``get_zonal_executor`` cree uno nuevo.
+    """
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _ejecutar(trabajos):
+    """
+    Ejecuta en el pool los trabajos (función, argumentos) y devuelve sus
+    resultados en orden. Si un worker muere (p. ej. por falta de memoria) el pool
+    queda roto: se recrea y los trabajos se reintentan una vez.
+    """
+    for intento in range(2):
+        executor = get_zonal_executor()
+        try:
+            futuros = [executor.submit(fn, *args) for fn, args in trabajos]
+            return [futuro.result() for futuro in futuros]
+        except BrokenProcessPool as e:
+            _descartar_executor(executor)
+            if intento:
+                raise
+            print(f"⚠️ Pool de estadísticas roto ({e}); se recrea y se reintenta.")
+
+
+def estadisticas_parcelas(gdf, image_paths):
+    """
+    Estadísticas de cada parcela de ``gdf`` en cada raster, con un raster de
+    etiquetas (``ZONAL_MODE=labels``) o parcela a parcela. Se ejecuta en los
+    workers del pool.
+
+    Returns:
+        list: Por cada parcela, la lista de estadísticas por raster.
+    """
+    if zonal_labels_enabled():
+        return zonal_statistics_labels(gdf, image_paths)
+    return [zonal_statistics(gdf.iloc[[i]], image_paths) for i in range(len(gdf))]
+
+
+def zonal_statistics_pool(gdf, tareas):
+    """
+    Calcula ``estadisticas_parcelas`` para varios conjuntos de rasters (p. ej.
+    uno por índice) en los procesos del pool. Con ``ZONAL_MODE=labels`` cada
+    trabajo es un raster con todas las parcelas, así que cada raster se lee una
+    sola vez; parcela a parcela, las parcelas se reparten en fragmentos
+    contiguos. Los resultados se unen en orden, así que no dependen del reparto.
+
+    Args:
+        gdf (GeoDataFrame): Parcelas.
+        tareas (dict): Rasters de cada clave.
+
+    Returns:
+        dict: Por clave, la lista por parcela (en el orden de ``gdf``) de
+        estadísticas por raster.
+    """
+    rutas = [(clave, ruta) for clave, image_paths in tareas.items() for ruta in image_paths]
+    reparto = len(rutas) if zonal_labels_enabled() else len(gdf)
+    # Los rasters en memoria sólo existen en este proceso.
+    if ZONAL_MAX_WORKERS <= 1 or reparto < 2 or any(en_memoria(ruta) for _, ruta in rutas):
+        return {clave: estadisticas_parcelas(gdf, image_paths) for clave, image_paths in tareas.items()}
+
+    if zonal_labels_enabled():
+        resultados = _ejecutar([(estadisticas_parcelas, (gdf, [ruta])) for _, ruta in rutas])
+        por_clave = {clave: [[] for _ in range(len(gdf))] for clave in tareas}
+        for (clave, _), por_parcela in zip(rutas, resultados):
+            for parcela, stats in zip(por_clave[clave], por_parcela):
+                parcela.extend(stats)
+        return por_clave
+
+    n_fragmentos = min(len(gdf), ZONAL_MAX_WORKERS * _FRAGMENTOS_POR_WORKER)
+    fragmentos = [f for f in np.array_split(np.arange(len(gdf)), n_fragmentos) if len(f)]
+    claves = list(tareas)
+    resultados = _ejecutar([
+        (estadisticas_parcelas, (gdf.iloc[f], tareas[clave]))
+        for clave in claves
+        for f in fragmentos
+    ])
+    return {
+        clave: [
+            parcela
+            for por_fragmento in resultados[i * len(fragmentos):(i + 1) * len(fragmentos)]
+            for parcela in por_fragmento
+        ]
+        for i, clave in enumerate(claves)
+    }